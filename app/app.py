@@ -1,7 +1,12 @@
-from shiny import App, Inputs, Outputs, Session, ui
+from shiny import App, Inputs, Outputs, Session, reactive, ui
 import data_map
 import data_table
 import shinyswatch
+from starlette.routing import Route
+from metrics_util import metrics_endpoint, start_metrics_log
+from reload_util import start_reload_watcher
+from worker_util import shutdown_executor
+import config
 
 #----------------------------------------------------------------
 # Header for the User Interface Shell (Using HTML tags)
@@ -19,42 +24,80 @@ header = ui.panel_title(
 #----------------------------------------------------------------
 # Defining the body which will contain the Map and the DataFrame. 
 # Both components are defined as a module for better readability.
+# The ui is built for every page load, so that new sessions get the filter choices of the current data.
 #----------------------------------------------------------------
 
-body = ui.navset_card_pill(
-    ui.nav_panel(
-        "Interactive Map",
-        ui.tags.p(),
-        data_map.map_ui("map"),
-    ),
-    ui.nav_panel(
-        "Data Table",
-        ui.tags.p(),
-        data_table.data_table_ui("data_table"),
+def body():
+    return ui.navset_card_pill(
+        ui.nav_panel(
+            "Interactive Map",
+            ui.tags.p(),
+            data_map.map_ui("map"),
+            value="map",
+        ),
+        ui.nav_panel(
+            "Data Table",
+            ui.tags.p(),
+            data_table.data_table_ui("data_table"),
+            value="data_table",
+        ),
+        id="tab",
     )
-)
 
 #----------------------------------------------------------------
 # Building the app_ui using a theme and the header and body.
 #----------------------------------------------------------------
 
 
-app_ui = ui.page_fluid(
-    shinyswatch.theme.minty, 
-    header, 
-    body,
-    )
+def app_ui(request):
+    return ui.page_fluid(
+        shinyswatch.theme.minty, 
+        header, 
+        body(),
+        )
 
 #----------------------------------------------------------------
 # Building the server, which constits of two server modules.
 # One for each functionality, map and dataframe.
+# With LAZY_TABS, the server of a tab is only started when the tab is shown for the first time,
+# so a session that never opens the table never computes it.
 #----------------------------------------------------------------
 
+tab_servers = {
+    "map": lambda: data_map.map_server("map"),
+    "data_table": lambda: data_table.data_table_server("data_table"),
+}
+
 def server(input: Inputs, output: Outputs, session: Session):
-    data_map.map_server("map")
-    data_table.data_table_server("data_table")
+    if not config.LAZY_TABS:
+        for start in tab_servers.values():
+            start()
+        return
+    
+    started = set()
+    
+    @reactive.effect
+    def start_tab():
+        tab = input.tab()
+        if tab in tab_servers and tab not in started:
+            started.add(tab)
+            with reactive.isolate():
+                tab_servers[tab]()
 
 ################################
 # Create the App Instance:
 
 app = App(app_ui, server)
+
+# The worker pool is stopped with the server, its processes would otherwise be left running.
+app.on_shutdown(shutdown_executor)
+
+# Metrics of this worker, in the Prometheus text format on /metrics and/or as a periodic log.
+if config.METRICS_ENDPOINT:
+    app.starlette_app.router.routes.insert(0, Route("/metrics", metrics_endpoint))
+if config.METRICS_LOG_INTERVAL > 0:
+    start_metrics_log(config.METRICS_LOG_INTERVAL)
+
+# Reloading changed data files in the background, without restarting the worker.
+if config.RELOAD_INTERVAL > 0:
+    start_reload_watcher(config.RELOAD_INTERVAL)
@@ -0,0 +1,166 @@
+import sys
+import threading
+from collections import OrderedDict
+from functools import wraps
+from typing import Any, Callable, Hashable
+import numpy as np
+import pandas as pd
+
+#----------------------------------------------------------------
+# Process-wide memoization of results that many sessions ask for, e.g. the default table selection.
+# Results are kept in LRU order within a byte budget, so the cache can never grow without bound.
+#----------------------------------------------------------------
+
+# All caches of the process by name, so that their statistics can be reported in one place.
+caches = {}
+
+# Generation of the process-wide models, increased when they are swapped after a reload (see data_util.set_models).
+# Cached values belong to the generation they were computed in. Values of a previous generation are never returned,
+# and values whose computation overlapped a swap are not stored, so no reader mixes old and new data.
+_generation = {"value": 0}
+
+
+def data_generation() -> int:
+    """
+    Current generation of the process-wide models.
+    Returns:
+        int: Number of swaps so far.
+    """
+    return _generation["value"]
+
+
+def next_data_generation() -> None:
+    """
+    Invalidates everything cached for the previous models. Called right after the models were swapped.
+    """
+    _generation["value"] += 1
+
+
+def generation_cache(fn: Callable) -> Callable:
+    """
+    Memoizes a function of hashable arguments (like lru_cache without a limit) for the current generation of the models.
+    Returns:
+        Callable: The cached function, with cache_clear and the original function as __wrapped__.
+    """
+    entries = {}
+    lock = threading.Lock()
+
+    @wraps(fn)
+    def cached(*args):
+        generation = data_generation()
+        with lock:
+            entry = entries.get(args)
+        if entry is not None and entry[0] == generation:
+            return entry[1]
+        value = fn(*args)
+        with lock:
+            if data_generation() == generation:
+                entries[args] = (generation, value)
+        return value
+
+    def cache_clear() -> None:
+        with lock:
+            entries.clear()
+
+    cached.cache_clear = cache_clear
+    return cached
+
+
+class ResultCache():
+    """
+    The ResultCache class is a thread safe LRU cache with a byte budget and hit/miss counters.
+    Cached values are shared between sessions and must not be modified in place.
+    """
+
+    def __init__(self, name: str, max_bytes: int) -> None:
+        self.name = name
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.generation = 0
+        self.data_generation = data_generation()
+        self.lock = threading.Lock()
+        caches[name] = self
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        """
+        Returns the cached value for the key, or computes, stores and returns it.
+        Returns:
+            Any: The (possibly cached) result.
+        """
+        with self.lock:
+            # Entries of previous models are dropped on the first access after a swap.
+            if self.data_generation != data_generation():
+                self._drop()
+                self.data_generation = data_generation()
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            self.misses += 1
+            generation = (self.generation, self.data_generation)
+
+        # Computing outside of the lock, two sessions asking at once both compute, but nobody waits.
+        value = compute()
+        size = size_of(value)
+
+        with self.lock:
+            # A value computed before the cache was cleared (e.g. from reloaded data) is returned, but not stored.
+            if key not in self.entries and size <= self.max_bytes and generation == (self.generation, data_generation()):
+                self.entries[key] = (value, size)
+                self.bytes += size
+                while self.bytes > self.max_bytes:
+                    _, (_, evicted) = self.entries.popitem(last=False)
+                    self.bytes -= evicted
+                    self.evictions += 1
+        return value
+
+    def clear(self) -> None:
+        """
+        Removes all entries, the counters are kept.
+        """
+        with self.lock:
+            self._drop()
+
+    def _drop(self) -> None:
+        self.entries.clear()
+        self.bytes = 0
+        self.generation += 1
+
+    def stats(self) -> dict:
+        """
+        Current statistics of the cache.
+        Returns:
+            dict: Entries, bytes, budget, hits, misses and evictions.
+        """
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+def size_of(value: Any) -> int:
+    """
+    Estimates the memory used by a cached value.
+    Returns:
+        int: Size in bytes.
+    """
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(size_of(k) + size_of(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(size_of(item) for item in value)
+    return sys.getsizeof(value)
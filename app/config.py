@@ -0,0 +1,99 @@
+import os
+
+#----------------------------------------------------------------
+# Settings that can be changed per deployment through environment variables.
+# Every setting has a default, so the app runs without any configuration.
+#----------------------------------------------------------------
+
+def env_flag(name: str, default: bool) -> bool:
+    """
+    Reads a boolean setting. "1", "true", "yes" and "on" count as enabled.
+    Returns:
+        _type_: bool
+    """
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def env_float(name: str, default: float) -> float:
+    """
+    Reads a decimal setting.
+    Returns:
+        _type_: float
+    """
+    value = os.environ.get(name)
+    return default if value is None else float(value)
+
+
+def env_int(name: str, default: int) -> int:
+    """
+    Reads an integer setting.
+    Returns:
+        _type_: int
+    """
+    value = os.environ.get(name)
+    return default if value is None else int(value)
+
+
+# Keep one map per session and only push new values into its layers when a filter changes,
+# instead of building a new map (and sending all geometry again) on every change.
+INCREMENTAL_MAP = env_flag("DASHBOARD_INCREMENTAL_MAP", True)
+
+# Number of rows the data table sends to the browser per page.
+TABLE_PAGE_SIZE = env_int("DASHBOARD_TABLE_PAGE_SIZE", 25)
+
+# Byte budget of each process-wide result cache (table selections, choropleth data).
+CACHE_MAX_BYTES = env_int("DASHBOARD_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+
+# Expose the metrics of each worker in the Prometheus text format on /metrics. Off by default, as the endpoint
+# is public on a public dashboard; enable it where /metrics is only reachable by the monitoring.
+METRICS_ENDPOINT = env_flag("DASHBOARD_METRICS_ENDPOINT", False)
+
+# Share of the renders whose payload (JSON sent to the browser) is serialized to record its size. Serializing
+# the styled map layer costs more than building it from the caches, so it is off by default (0) and 1 measures all.
+METRICS_PAYLOAD_SAMPLE = env_float("DASHBOARD_METRICS_PAYLOAD_SAMPLE", 0)
+
+# Write all metrics to the log every given number of seconds (0 disables the log).
+METRICS_LOG_INTERVAL = env_float("DASHBOARD_METRICS_LOG_INTERVAL", 0)
+
+# Renders taking at least this many seconds are logged together with their filters.
+SLOW_RENDER_SECONDS = env_float("DASHBOARD_SLOW_RENDER_SECONDS", 0.5)
+
+# Profile every render with cProfile and write the results to PROFILE_DIR (expensive, for debugging only).
+PROFILE_RENDERS = env_flag("DASHBOARD_PROFILE_RENDERS", False)
+PROFILE_DIR = os.environ.get("DASHBOARD_PROFILE_DIR", os.path.join(os.path.dirname(__file__), ".profiles"))
+
+# Run the heavy part of the map and table renders in a worker pool instead of on the event loop:
+# "inline" (no pool), "thread" or "process". With a pool the map is always updated in place.
+RENDER_EXECUTOR = os.environ.get("DASHBOARD_RENDER_EXECUTOR", "inline").strip().lower()
+RENDER_WORKERS = env_int("DASHBOARD_RENDER_WORKERS", min(4, os.cpu_count() or 1))
+
+# Filter changes that follow each other within this many seconds are coalesced into one render
+# of the final state (0 renders every change).
+FILTER_DEBOUNCE_SECONDS = env_float("DASHBOARD_FILTER_DEBOUNCE_SECONDS", 0.3)
+
+# Only apply the map and table filters when the "Apply filters" button is pressed.
+APPLY_FILTERS = env_flag("DASHBOARD_APPLY_FILTERS", False)
+
+# Start the server of a tab (map or table) only when the tab is shown for the first time.
+LAZY_TABS = env_flag("DASHBOARD_LAZY_TABS", True)
+
+# Memory-map the cached dataset read-only, so that all worker processes on a machine share one copy of it
+# (e.g. uvicorn --workers N). Without it every worker loads its own copy.
+SHARED_DATA = env_flag("DASHBOARD_SHARED_DATA", True)
+
+# Engine for the table selections: "pandas" (in memory), "sqlite" or "duckdb" (requires the duckdb package).
+# The embedded engines query a database file built next to the csv. They do not reduce the memory of a worker:
+# the DataModel still holds the full dataset and the dense cube for every engine (for the map and the exports).
+QUERY_BACKEND = os.environ.get("DASHBOARD_QUERY_BACKEND", "pandas").strip().lower()
+
+# Check the data files (csv, centroids, geojson) for changes every given number of seconds and reload them
+# in the background, without restarting the workers. Opt-in: a value above 0 starts a watcher thread in every
+# worker when the app is imported, and lets the sessions poll the data version. 0 (default) disables the reload.
+RELOAD_INTERVAL = env_float("DASHBOARD_RELOAD_INTERVAL", 0)
+
+# Rows per chunk when the table is exported. Only the positions of the selected rows are selected at once,
+# the values of every chunk are taken, encoded and sent on their own (xlsx is completed in a temporary file).
+EXPORT_CHUNK_ROWS = env_int("DASHBOARD_EXPORT_CHUNK_ROWS", 5000)
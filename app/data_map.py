@@ -1,29 +1,38 @@
-from shiny import ui, module, Session, render
-from ipyleaflet import Map, GeoJSON, Popup, Choropleth
-from shinywidgets import output_widget, render_widget
+from math import isnan
+from typing import Optional
+from shiny import ui, module, reactive, Session, render
+from shinywidgets import output_widget, reactive_read, render_widget
 from ipywidgets import HTML
-from data_util import DataModel, CountryModel
-from map_util import GeoJTransformer
-from branca.colormap import linear
+from data_util import get_country_model, get_data_model
+from map_util import GeoJTransformer, build_choropleth, detail_level, get_colormap
+from metrics_util import render_span, record_payload
+from worker_util import RenderTask, use_workers
+from input_util import apply_button, coalesce_inputs
+from reload_util import data_version
+import config
 
 #----------------------------------------------------------------
-# Loading the DataModel and CountryModel objects from the data_util module. 
+# Loading the shared DataModel from the data_util module. 
 # This helps to separate the data transformation from the ui code.
+# ipyleaflet (and with it branca) and the CountryModel take a while to load. To keep the startup of a worker short,
+# they are only loaded in the functions using them, when the first map of the process is rendered.
+# The DataModel is looked up on every use, as it is replaced when the data files are reloaded.
 #----------------------------------------------------------------
 
-dm = DataModel()
-cm = CountryModel()
-
 #----------------------------------------------------------------
 # Loading the dataset and related information such as parameters for filtering.
 #----------------------------------------------------------------
 
-cancer_types = sorted(dm.get_cancer_types())
-units = dm.get_units() 
-# removed the last year as data was not complete enough for representation on map.
-years = dm.get_years()[:-1] 
-data_dictionary = dm.get_data_dictionary()
-data = dm.get_data()
+def filter_choices(cancer_type: Optional[str] = None) -> dict:
+    # Choices of the map filters, by input id. The units are those of the cancer type (default: the first one).
+    dm = get_data_model()
+    cancer_types = sorted(dm.get_cancer_types())
+    return {
+        # removed the last year as data was not complete enough for representation on map.
+        "year_map": [str(year) for year in dm.get_years()[:-1]],
+        "cancer_type_map": cancer_types,
+        "units_map": dm.get_units(cancer_type if cancer_type in cancer_types else cancer_types[0]),
+    }
 
 #----------------------------------------------------------------
 # Specifying the map ui, which is integrated into the ui defined in app.py.
@@ -32,15 +41,17 @@ data = dm.get_data()
 # module.ui decorator allows for separation of ui components into different files.
 @module.ui
 def map_ui():
+    choices = filter_choices()
     container = ui.card(
         ui.card_header(ui.output_text("map_header")),
         ui.layout_sidebar(
             ui.sidebar(
-                ui.input_select(id="year_map", label="Year:", choices=years),
+                ui.input_select(id="year_map", label="Year:", choices=choices["year_map"]),
                 ui.input_select(
-                    id="cancer_type_map", label="Cancer Type:", choices=cancer_types
+                    id="cancer_type_map", label="Cancer Type:", choices=choices["cancer_type_map"]
                 ),
-                ui.input_select(id="units_map", label="Units:", choices=units),
+                ui.input_select(id="units_map", label="Units:", choices=choices["units_map"]),
+                apply_button("apply_filters_map"),
                 title="Map Filters:",
                 bg="#ffffff",
             ),
@@ -61,12 +72,43 @@ def map_ui():
 @module.server
 def map_server(input, output, session: Session):
     
+    # Selected filters as (year, cancer type, unit). A burst of changes is coalesced into one update of the map.
+    
+    def read_filters():
+        year, cancer_type, unit = int(input.year_map()), input.cancer_type_map(), input.units_map()
+        # Until the units of a newly selected cancer type are shown, the previous unit may not exist for it.
+        # The first unit is used then, which is also the one refresh_units selects.
+        units = get_data_model().get_units(cancer_type)
+        return year, cancer_type, unit if unit in units else units[0]
+    
+    selected = coalesce_inputs("map", read_filters, input.apply_filters_map)
+    
+    # After a reload of the data, the filters offer the choices of the new data. Selections that still exist are kept.
+    
+    @reactive.effect
+    @reactive.event(data_version, ignore_init=True)
+    def refresh_filters():
+        for id, choices in filter_choices(input.cancer_type_map()).items():
+            current = input[id]()
+            ui.update_select(id, choices=choices, selected=current if current in choices else None)
+    
+    # Only the units available for the selected cancer type are offered (screening per incidence needs screening data).
+    
+    @reactive.effect
+    @reactive.event(input.cancer_type_map, ignore_init=True)
+    def refresh_units():
+        units = get_data_model().get_units(input.cancer_type_map())
+        with reactive.isolate():
+            current = input.units_map()
+        ui.update_select("units_map", choices=units, selected=current if current in units else None)
+    
     # Definition of a header as a text output. Lets users see the applied filters in one sentence.
     
     @output
     @render.text
     def map_header():
-        text = f"This map is showing the {input.units_map()} for {input.cancer_type_map()} in {input.year_map()}. (Non-clickable countries have no corresponding data)"
+        year, cancer_type, unit = selected()
+        text = f"This map is showing the {unit} for {cancer_type} in {year}. (Non-clickable countries have no corresponding data)"
         return text
 
     # Definition of a footer as a text output. Lets useres see additional information about the selected filters id applicable.
@@ -74,16 +116,47 @@ def map_server(input, output, session: Session):
     @output
     @render.text
     def map_footer():
-        if not input.units_map() == "Total Number":
-            text = data_dictionary.get(input.cancer_type_map(), "Filters are applied.")
+        _, cancer_type, unit = selected()
+        if not unit == "Total Number":
+            # Derived metrics are explained first, followed by the information on the cancer type.
+            infos = get_data_model().get_data_dictionary()
+            text = " ".join(info for info in (infos.get(unit), infos.get(cancer_type)) if info) or "Filters are applied."
         else:
             text = "Filters are applied."
         return text
     
+    # Filters that are currently shown on the map. The popup handler reads them from here,
+    # so that popups always match the data of the choropleth layer.
+    
+    shown = {}
+    
+    def show(choro, year, cancer_type, unit):
+        # Same lookups as in map(), applied to the existing choropleth layer.
+        col = get_data_model().get_measure(cancer_type, unit)
+        choro.update(GeoJTransformer().get_choro_dict(year, col))
+        shown.update(year=year, cancer_type=cancer_type, unit=unit, col=col, version=data_version())
+    
     # rendering the widget (map) from the ipyleaflet library.
     
+    # Selected filters, added to the log when a render is slow.
+    def filters():
+        year, cancer_type, unit = selected()
+        return {"year": year, "cancer_type": cancer_type, "unit": unit}
+    
+    # Style of the choropleth layer.
+    def new_layer(**data):
+        from layer_util import ChoroplethLayer
+        return ChoroplethLayer(
+            **data,
+            colormap=get_colormap(),
+            border_color='black',
+            hover_style={"fillColor": "#45B08C", "dashArray": "0", "fillOpacity": 0.5},
+            style={'fillOpacity': 0.7, 'dashArray': '5, 5'})
+    
     @render_widget
+    @render_span("map", filters)
     def map():
+        from ipyleaflet import Map, Popup
         
         # Definition of map canvas and its starting point. Zoom is possible with mousewheel.
         
@@ -91,70 +164,74 @@ def map_server(input, output, session: Session):
                 center=(50, 10), 
                 scroll_wheel_zoom=True)
         
-        # Retrival of geographic data (MultiPolygons) for generation of the geo layer that shows country borders. 
-        
-        geo_obj = GeoJTransformer()
-        geo_data = geo_obj.get_geo_data()
-        
-        # Definition of the GeoJSON layer. This is the first layer on the map, which outlines the country borders.
-        
-        geo_json_layer = GeoJSON(
-            data=geo_data,
-            style={
-                "color": "grey",
-                "opacity": 1.0,
-                "fillOpacity": 0.1,
-                "weight": 1,
-            },
-        )
-        
-        # Helper function to get the corresponding column for selected filters "Cancer Type" and "Unit".
-        # This has been done to avoid duplication of data frames with different column names. Is used for filtering data.
-        
-        def get_data_column():
-            if input.units_map() == "Total Number":
-                return str(data.columns[data.columns.str.contains('_n') & data.columns.str.contains(str.lower(input.cancer_type_map().split(' ')[0]))][0])
+        if use_workers():
+            
+            # With a worker pool the layer starts empty, its data is prepared in the pool and applied by apply_map.
+            
+            choro = new_layer()
+        else:
+            
+            # In incremental mode the map is only built once per session, later filter changes are applied by update_map.
+            
+            # Otherwise the map is built again for every change of the filters or of the data.
+            
+            if config.INCREMENTAL_MAP:
+                with reactive.isolate():
+                    year, cancer_type, unit = selected()
+                    version = data_version()
             else:
-                return str(data.columns[data.columns.str.contains('_incidence') & data.columns.str.contains(str.lower(input.cancer_type_map().split(' ')[0]))][0])
-        
-        col = get_data_column()
-        
-        # Retrieval of choropleth data. This is another layer on top of the geoJSON layer that is tinted according to the data points for each country.
-        # This behaves similar to a heatmap.
-        # Data is accepted only as dictionary, therefore utilising dict and zip functions. 
-        
-        choro_data = geo_obj.get_choro_data()
-        data_y = choro_data[(choro_data["year"] == int(input.year_map())) | (choro_data["year"] == 0)]
-        choro_filtered = dict(zip(data_y["id"], data_y[col]))        
-        
-        # Building the choropleth layer:
-        choro = Choropleth(
-            geo_data=geo_data,
-            choro_data=choro_filtered, 
-            colormap=linear.Purples_04,
-            border_color='black',
-            hover_style={"fillColor": "#45B08C", "dashArray": "0", "fillOpacity": 0.5},
-            style={'fillOpacity': 0.7, 'dashArray': '5, 5'})
+                year, cancer_type, unit = selected()
+                version = data_version()
+            
+            # Retrival of geographic data (MultiPolygons) for the choropleth layer, which also draws the country borders. 
+            # The geo data is simplified to the level of detail that is visible at the current zoom, and only sent once.
+            
+            geo_obj = GeoJTransformer()
+            geo_data = geo_obj.get_geo_data(zoom=m.zoom)
+            
+            # Canonical measure key (column) for the selected filters "Cancer Type" and "Unit".
+            # This has been done to avoid duplication of data frames with different column names. Is used for looking up data.
+            
+            col = get_data_model().get_measure(cancer_type, unit)
+            
+            # Retrieval of choropleth data. This is the layer that is tinted according to the data points for each country.
+            # This behaves similar to a heatmap.
+            # Data is accepted only as dictionary, keyed by feature id. The dictionaries are cached per year and measure.
+            
+            choro_filtered = geo_obj.get_choro_dict(year, col)
+            
+            # Building the choropleth layer:
+            choro = new_layer(geo_data=geo_data, choro_data=choro_filtered)
+            shown.update(year=year, cancer_type=cancer_type, unit=unit, col=col, version=version)
         
         
         # On-Click Event Handler: This is an event handler that takes the callback as an input.
         # It allows users to click on highlighted countries and spawns a popup window at the countries centroid. 
+        # The country is resolved from the clicked coordinate with the spatial index of the CountryModel.
         
-        def on_click(event, feature, **kwargs):
-            # Get country name from the callback information (feature). 
-            country_name = feature["properties"]["name"]
+        def on_click(**kwargs):
+            if kwargs.get("type") != "click":
+                return
             
-            # Get country position using the in CountryModel object implemented get_centroid method.
-            pos = cm.get_centroid(country_name)
+            # Get the country at the clicked position, countries without data are not clickable.
+            country = get_country_model().locate(*kwargs["coordinates"])
+            if country is None or country.data_key is None or not shown:
+                return
+            country_name = country.data_key
             
-            # Mask for dataframe to filter data on year and country.
-            mask = (data["year"] == int(input.year_map())) & (data["country"] == country_name)
+            # Country position from the centroid information in the CountryModel.
+            pos = country.centroid
+            
+            # Look up the value for the country and year directly in the DataModel cube.
+            value = get_data_model().get_value(country_name, shown["col"], shown["year"])
+            if isnan(value):
+                value = "not available"
             
             # creating the content for the pop-up as HTML content. 
             pop_html = HTML()
             pop_html.value = f"""
                 <h5>{country_name}</h5>
-                <p>The {str.lower(str(input.units_map()))} for {str.lower(str(input.cancer_type_map()))} was <b>{data[mask][col].values[0]}</b> in {country_name}.</p>
+                <p>The {str.lower(str(shown["unit"]))} for {str.lower(str(shown["cancer_type"]))} was <b>{value}</b> in {country_name}.</p>
                 """
             # Create the pop_up, position based on the centroid information in CountryModel
             popup = Popup(
@@ -168,9 +245,93 @@ def map_server(input, output, session: Session):
             m.add(popup)
         
         
-        m.add_layer(geo_json_layer) # Add first layer (geoJSON)
-        m.add_layer(choro) # Add second layer (choropleth)
-        choro.on_click(on_click) # Add event listener & handler (on click) with popup specified in on_click function.
+        m.add_layer(choro) # Add the choropleth layer
+        m.on_interaction(on_click) # Add event listener & handler (on click) with popup specified in on_click function.
         
         # Finally, return the map.
+        record_payload("map", choro.data)
         return m
+    
+    # Offloaded updates: the choropleth for the filters and the level of detail of the zoom is prepared and styled
+    # in the worker pool. A preparation that is still running when the filters or the zoom change again is cancelled.
+    
+    if use_workers():
+        choropleth_task = RenderTask("map_update", build_choropleth)
+        requested = {}
+        
+        @reactive.effect
+        def request_map():
+            year, cancer_type, unit = selected()
+            version = data_version()
+            m = map.widget
+            level = detail_level(reactive_read(m, "zoom"))
+            
+            # Zooming within one level of detail needs no new data.
+            if requested.get("key") != (id(m), level, year, cancer_type, unit, version):
+                requested["key"] = (id(m), level, year, cancer_type, unit, version)
+                choropleth_task.invoke(level, year, cancer_type, unit)
+        
+        @reactive.effect
+        @render_span("map_update", filters)
+        def apply_map():
+            from ipyleaflet import Popup
+            from layer_util import ChoroplethLayer
+            choropleth = choropleth_task.result()
+            m = map.widget
+            
+            # Popups still show the values of the previous filters, so they are closed.
+            if (shown.get("year"), shown.get("col")) != (choropleth.year, choropleth.measure):
+                for layer in list(m.layers):
+                    if isinstance(layer, Popup):
+                        m.remove(layer)
+            
+            choro = next(layer for layer in m.layers if isinstance(layer, ChoroplethLayer))
+            choro.apply(choropleth)
+            shown.update(year=choropleth.year, cancer_type=choropleth.cancer_type, unit=choropleth.unit, col=choropleth.measure)
+            record_payload("map_update", choro.data)
+    
+    # Incremental updates: the existing map keeps its geometry, position and zoom.
+    # Only the choropleth values, colormap bounds and popup context are replaced.
+    
+    elif config.INCREMENTAL_MAP:
+        
+        @reactive.effect
+        @render_span("map_update", filters)
+        def update_map():
+            from ipyleaflet import Popup
+            from layer_util import ChoroplethLayer
+            year, cancer_type, unit = selected()
+            version = data_version()
+            
+            # Waits until the map has been rendered for this session, which already shows its initial filters.
+            m = map.widget
+            if (shown["year"], shown["cancer_type"], shown["unit"], shown["version"]) == (year, cancer_type, unit, version):
+                return
+            
+            # Popups still show the values of the previous filters, so they are closed.
+            for layer in list(m.layers):
+                if isinstance(layer, Popup):
+                    m.remove(layer)
+            
+            choro = next(layer for layer in m.layers if isinstance(layer, ChoroplethLayer))
+            show(choro, year, cancer_type, unit)
+            record_payload("map_update", choro.data)
+    
+    # Level of detail: when the user zooms far enough to see more (or less) detail, the geometry is swapped.
+    # With a worker pool, request_map takes care of it.
+    
+    if not use_workers():
+        
+        @reactive.effect
+        @render_span("map_detail")
+        def update_detail():
+            from layer_util import ChoroplethLayer
+            m = map.widget
+            zoom = reactive_read(m, "zoom")
+            # After a reload of the geometry, the same zoom gets new geo data.
+            data_version()
+            choro = next(layer for layer in m.layers if isinstance(layer, ChoroplethLayer))
+            geo_data = GeoJTransformer().get_geo_data(zoom=zoom)
+            if choro.geo_data is not geo_data:
+                choro.geo_data = geo_data
+                record_payload("map_detail", choro.data)
@@ -1,12 +1,26 @@
-from shiny import ui, module, Session, render
-from data_util import DataModel
+from shiny import ui, module, reactive, Session, render
+from data_util import get_data_model
+from table_util import TablePage, build_page, page_count, pretty_columns
+from metrics_util import metrics, render_span, record_payload
+from worker_util import RenderTask, iterate_in_thread, use_workers
+from input_util import apply_button, coalesce_inputs
+from export_util import available_formats, export_chunks, export_frames, formats
+from reload_util import data_version
+import config
 
 #----------------------------------------------------------------
-# Loading the DataModel from the data_util module. 
+# Loading the shared DataModel from the data_util module. 
 # This helps to separate the data transformation from the ui code.
+# The DataModel is looked up on every use, as it is replaced when the data files are reloaded.
 #----------------------------------------------------------------
 
-dm = DataModel()
+def sort_choices(columns: list[str]) -> dict:
+    # Columns that can be used for sorting, with their pretty names as labels.
+    columns = ["year", "country", *columns]
+    return dict(zip(columns, pretty_columns(columns)))
+
+def page_sizes() -> list[str]:
+    return [str(size) for size in sorted({10, 25, 50, 100, config.TABLE_PAGE_SIZE})]
 
 #----------------------------------------------------------------
 # module.ui decorator allows for separation of ui components into different files.
@@ -15,6 +29,7 @@ dm = DataModel()
 
 @module.ui
 def data_table_ui():
+    dm = get_data_model()
     container = (
         ui.card(
             ui.card_header(ui.output_text("table_header")),
@@ -27,7 +42,7 @@ def data_table_ui():
                                     label="Year Selection:"),
                     ui.input_selectize(id = "columns_table", 
                                     label = "Select Columns",
-                                    choices= list(dm.get_data().columns)[2:],
+                                    choices= dm.get_columns(),
                                     selected = list(dm.get_data().columns)[-7:-5],
                                     multiple = True),
                     ui.input_selectize(id = "countries_table", 
@@ -35,9 +50,24 @@ def data_table_ui():
                                     choices= dm.get_countries(),
                                     selected = dm.get_countries()[:3],
                                     multiple = True),
+                    apply_button("apply_filters_table"),
                     title="Table Filters", 
                     bg="#ffffff"),
+                # Sorting, searching and paging are done on the server, only the current page is sent to the browser.
+                ui.layout_columns(
+                    ui.input_text(id="search_table", label="Search:", placeholder="Country, year or value"),
+                    ui.input_select(id="sort_table", label="Sort by:", choices=sort_choices(list(dm.get_data().columns)[-7:-5])),
+                    ui.input_select(id="order_table", label="Order:", choices={"asc": "Ascending", "desc": "Descending"}),
+                    ui.input_select(id="page_size_table", label="Rows per page:", choices=page_sizes(), selected=str(config.TABLE_PAGE_SIZE)),
+                    ui.input_numeric(id="page_table", label="Page:", value=1, min=1),
+                ),
                 ui.output_data_frame("total_df"), 
+                ui.output_text("page_info"),
+                # Export of all rows of the selection (not only the current page), streamed in chunks.
+                ui.layout_columns(
+                    ui.input_select(id="export_format_table", label="Export as:", choices=available_formats()),
+                    ui.download_button("export_table", "Download selection"),
+                ),
             ),
             full_screen= True,
         ),
@@ -53,32 +83,106 @@ def data_table_ui():
 @module.server
 def data_table_server(input, output, session: Session):
     
+    # Selected filters as (years, countries, columns). A burst of changes (e.g. adding five countries) is coalesced
+    # into one render of the final state. The search text is debounced as well, the paging controls are not.
+    filters = coalesce_inputs("table", lambda: (tuple(int(year) for year in input.year_table()), list(input.countries_table()), list(input.columns_table())),
+                              input.apply_filters_table)
+    search = coalesce_inputs("table_search", lambda: input.search_table())
+    
     # Rendering the header that indicated the current selection to the user.
     @output
     @render.text
     def table_header():
-        text = f"Showing data for {len(input.columns_table())} type(s) and {len(input.countries_table())} location(s)."
+        _, countries, columns = filters()
+        text = f"Showing data for {len(columns)} type(s) and {len(countries)} location(s)."
         return text
     
-    # Rendering the data frame.
-    @render.data_frame  
-    def total_df():
-        
-        # Get the data using the DataModel.
-        df = dm.get_data()
-        
-        # Create Masks for years and coutries.
-        year_mask = (df["year"].isin([*range(*input.year_table()),input.year_table()[-1]]))
-        country_mask = (df["country"].isin(input.countries_table()))
-        
-        # Get columns to filter on.
-        columns = input.columns_table()
+    # After a reload of the data, the filters offer the choices of the new data. Selections that still exist are kept.
+    @reactive.effect
+    @reactive.event(data_version, ignore_init=True)
+    def refresh_filters():
+        dm = get_data_model()
+        years = dm.get_years()
+        first, last = (min(max(int(year), years[0]), years[-1]) for year in input.year_table())
+        ui.update_slider("year_table", min=years[0], max=years[-1], value=[first, last])
+        for id, choices in (("columns_table", dm.get_columns()), ("countries_table", dm.get_countries())):
+            ui.update_selectize(id, choices=choices, selected=[value for value in input[id]() if value in choices])
+    
+    # Filters of the table, in the form build_page takes them.
+    def query() -> tuple:
+        return (*filters(),
+                search(),
+                input.sort_table(),
+                input.order_table() == "desc",
+                input.page_table(),
+                int(input.page_size_table()))
+    
+    # The current page is built through the row index of the DataModel. Selections and their sorted views are cached
+    # and shared between sessions. With a worker pool the page is built there, and a page that is still being built
+    # when the filters change again is cancelled.
+    if use_workers():
+        page_task = RenderTask("total_df", build_page)
         
-        # Applying the filters on the dataset.
-        df = df[year_mask & country_mask][["year", "country", *columns]]
+        @reactive.effect
+        def request_page():
+            # A reload of the data builds the page again, with the same filters.
+            data_version()
+            page_task.invoke(*query())
         
-        # Prettier columns for presenting the data.
-        df.columns = df.columns.str.replace('_', ' ').str.title()
+        def current() -> TablePage:
+            return page_task.result()
+    else:
+        @reactive.calc
+        @render_span("table_page", lambda: {"years": filters()[0], "countries": len(filters()[1]), "columns": len(filters()[2])})
+        def current() -> TablePage:
+            data_version()
+            return build_page(*query())
+    
+    # Keeping the sort options in line with the selected columns.
+    @reactive.effect
+    def update_sort_choices():
+        choices = sort_choices(filters()[2])
+        with reactive.isolate():
+            selected = input.sort_table() if input.sort_table() in choices else "year"
+        ui.update_select("sort_table", choices=choices, selected=selected)
+    
+    # Going back to the first page whenever the rows or the page size change.
+    @reactive.effect
+    @reactive.event(filters, search, input.sort_table, input.order_table, input.page_size_table, ignore_init=True)
+    def reset_page():
+        ui.update_numeric("page_table", value=1)
+    
+    # Rendering the position of the current page.
+    @output
+    @render.text
+    def page_info():
+        page = current()
+        if page.n_rows == 0:
+            return "No rows match the selection."
+        start = (page.page - 1) * page.page_size
+        return f"Rows {start + 1} to {min(start + page.page_size, page.n_rows)} of {page.n_rows} (page {page.page} of {page_count(page.n_rows, page.page_size)})."
+    
+    # Rendering the data frame, only the rows of the current page are sent to the browser.
+    @render.data_frame  
+    @render_span("total_df")
+    def total_df():
+        df = current().rows
         
         # Returning the rendered datatable.
+        record_payload("total_df", lambda: df.to_json(orient="split"))
         return render.DataTable(df)
+    
+    # Exporting the selection, searched and sorted as in the table. The file is produced chunk by chunk in a thread,
+    # so a large export neither holds the whole file in memory nor blocks the other sessions.
+    def export_name() -> str:
+        first, last = filters()[0]
+        return f"oecd_cancer_{first}-{last}.{formats[input.export_format_table()].extension}"
+    
+    @render.download(filename=export_name, media_type=lambda: formats[input.export_format_table()].media_type)
+    async def export_table():
+        fmt = input.export_format_table()
+        years, countries, columns = filters()
+        query = (years, countries, columns, search(), input.sort_table(), input.order_table() == "desc", config.EXPORT_CHUNK_ROWS)
+        metrics.inc("exports", format=fmt)
+        async for chunk in iterate_in_thread(export_chunks(fmt, export_frames(*query))):
+            yield chunk
@@ -1,5 +1,18 @@
+import json
+import re
+import threading
+import unicodedata
+import numpy as np
 import pandas as pd
 from pathlib import Path
+from typing import NamedTuple, Optional
+from cache_util import next_data_generation
+from metrics_util import timed
+import config
+from derived_util import derive_metrics, derived_columns, units as derived_units, version as derived_version
+from query_util import create_backend
+from spatial_util import SpatialIndex
+from store_util import ColumnStore
 
 #----------------------------------------------------------------
 # Decided to create a separate module for the data loading and preparation part. 
@@ -12,6 +25,9 @@ class DataModel():
     """
     file_path = Path(__file__).parent / "OCED_simplified.csv"
     
+    # The source reports all measures with at most one decimal.
+    decimals = 1
+    
     # Dictionary to shorten the originally very long column names.
     rename_dict = {
         "Cervical cancer screening, programme data_% of females aged 20-69 screened": "cervical_cancer_screening_%f2069",
@@ -39,56 +55,132 @@ class DataModel():
         "Other Malignant neoplasms_Per 100 000 population": "other_cancer_incidence"
     }
     
-    def __init__(self) -> None:
-        # reading data from url into csv.
-        df = pd.read_csv(DataModel.file_path)
-
-        # Reduce data to the subset needed in this use case.
-        mask = ["year", "country"] + list(df.columns[(df.columns.str.contains('Malignant')) & 
-                (df.columns.str.contains('Per 100 000') | df.columns.str.contains('Number')) | 
-                (df.columns.str.contains('screening') & df.columns.str.contains('programme'))])
+    def __init__(self, file_path: Optional[Path] = None) -> None:
+        # Loading the prepared data from the binary cache, only parsing the csv if the cache is missing or outdated.
+        # The cache is stored next to the csv. Another csv with the same layout can be passed (e.g. for benchmarks).
+        file_path = Path(file_path or DataModel.file_path)
+        # With SHARED_DATA the cached arrays are memory-mapped read-only, so all workers share one copy of the data.
+        # Everything is loaded from one version directory of the cache, even if the csv is published again meanwhile.
+        store = ColumnStore(file_path, file_path.parent / ".cache" / file_path.stem)
+        directory = store.current()
+        with timed("data_cache_load"):
+            data = store.load(directory, mmap=config.SHARED_DATA)
+        if data is None:
+            # Only one worker parses the csv and publishes the cache, the others wait and then load it.
+            with store.lock():
+                directory = store.current()
+                data = store.load(directory, mmap=config.SHARED_DATA)
+                if data is None:
+                    version = store.version()
+                    with timed("data_csv_parse"):
+                        parsed = DataModel.read_csv(file_path)
+                    # A csv that changed while it was parsed is not published under the version taken before.
+                    directory = store.save(parsed, version) if store.fingerprint() == version[0] else None
+                    data = store.load(directory, mmap=True) if config.SHARED_DATA else None
+                    # The cache could not be written (e.g. a read-only deployment), the parsed data is used directly.
+                    data = parsed if data is None else data
+        
+        # Storing the data in an attribute. The shared instance is never modified afterwards.
+        self.data = data
+        # Content hash of the csv the data was read from, None if it is not cached.
+        self.source_version = None if directory is None else directory.name
+        
+        # The lists used for filtering only depend on the data, so they are derived once as well.
+        self._cancer_types = self._build_cancer_types()
+        self._screenings = self._build_screenings()
+        self._years = [int(year) for year in sorted(set(self.data["year"]))]
+        self._countries = list(sorted(set(self.data["country"])))
+        self._measures = list(self.data.columns[2:])
+        
+        # Derived metrics of every incidence (trends, rankings, screening per incidence), see derived_util.
+        # The incidences are taken in the order of the columns, so all workers agree on the layout of the cube.
+        self._incidences = [measure for measure in self._measures if "_incidence" in measure]
+        self._derived = derived_columns(self._incidences)
+        
+        # Dense cube of all measures and derived metrics, indexed by (year, country, measure). Map renders and popups
+        # only need to look values up here, instead of filtering the whole dataframe.
+        self._year_index = {year: i for i, year in enumerate(self._years)}
+        self._country_index = {country: i for i, country in enumerate(self._countries)}
+        self._measure_index = {measure: i for i, measure in enumerate(self._measures + self._derived)}
+        with timed("data_index_build"):
+            self._cube = self._load_cube(store, directory)
+        self._alignments = {}
+        
+        # Derived columns without any value (screening per incidence of cancers without screening) are not offered in the table.
+        has_values = ~np.isnan(self._cube[:, :, len(self._measures):]).all(axis=(0, 1))
+        self._columns = self._measures + [column for column, has in zip(self._derived, has_values) if has]
+        self._measure_keys = self._build_measure_keys()
         
-        # Storing the data in an attribute.
-        self.data = df[mask]
+        # Backend for the table selections (QUERY_BACKEND): an in-memory row index or an embedded database.
+        self.backend = create_backend(config.QUERY_BACKEND, self.data, file_path, self.source_version)
     
-    def clean_column_names(self) -> None:
+    @staticmethod
+    def read_csv(file_path: Optional[Path] = None) -> pd.DataFrame:
         """
-        Applying the clean column names from the dictionary to the dataset.
+        Reads only the columns needed in this use case from the csv, using compact data types.
+        Column names are cleaned and NaN values are filled before the data is returned.
+        Returns:
+            _type_: pd.DataFrame
         """
-        self.data = self.data.rename(columns= DataModel.rename_dict)
+        # Reduce data to the subset needed in this use case, before any text is parsed.
+        file_path = file_path or DataModel.file_path
+        header = pd.read_csv(file_path, nrows=0).columns
+        measures = [column for column in header if column in DataModel.rename_dict]
+        
+        dtypes = {"year": "int16", "country": "category"}
+        dtypes.update({column: "float32" for column in measures})
+        df = pd.read_csv(file_path, usecols=["year", "country", *measures], dtype=dtypes)
+        
+        # usecols keeps the order of the file, but the order is fixed here to be explicit.
+        # Only the measures can be missing, the categorical country column is left untouched.
+        df = df[["year", "country", *measures]].fillna({column: 0 for column in measures})
+        return df.rename(columns= DataModel.rename_dict)
     
     def get_data(self) -> pd.DataFrame:
         """
-        Cleans the column names and returns a dataframe that does not contain NaN values.
+        Returns the cleaned dataframe that does not contain NaN values.
+        The dataframe is shared between all modules and sessions and must not be modified in place.
         Returns:
             _type_: pd.DataFrame
         """
-        self.clean_column_names()
-        self.data = self.data.fillna(0)
         return self.data
     
+    def _build_cancer_types(self) -> list[str]:
+        cancer_types = []
+        for column in self.data.columns[2:]:
+            cancer_types.append(' '.join([word.capitalize() for word in column.split('_')[:2]]))
+        cancer_types.remove("Cervical Cancer") # Only exists for screenings.
+        return list(set(cancer_types))
+    
     def get_cancer_types(self) -> list[str]:
         """
         Creates a list of easy to read cancer types.
         Returns:
             _type_: list[str]
         """
-        self.clean_column_names()
-        cancer_types = []
-        for column in self.data.columns[2:]:
-            cancer_types.append(' '.join([word.capitalize() for word in column.split('_')[:2]]))
-        cancer_types.remove("Cervical Cancer") # Only exists for screenings.
-        return list(set(cancer_types))
+        return list(self._cancer_types)
     
-    def get_units(self) -> list[str]:
+    def get_units(self, cancer_type: Optional[str] = None) -> list[str]:
         """
-        Creates a list of easy to read units for filtering.
+        Creates a list of easy to read units for filtering, followed by the units of the derived metrics.
+        With a cancer type, only the units that have data for it (e.g. screening per incidence needs screening data).
         Returns:
             _type_: list[str]
         """
         units = ["Total Number",
                     "Incidence per 100.000"]
-        return sorted(units)
+        units = sorted(units) + list(derived_units)
+        if cancer_type is None:
+            return units
+        return [unit for unit in units if (cancer_type, unit) in self._measure_keys]
+    
+    def get_columns(self) -> list[str]:
+        """
+        Creates a list of the columns that can be shown in the table: the measures and the derived metrics.
+        Returns:
+            _type_: list[str]
+        """
+        return list(self._columns)
     
     def get_data_dictionary(self) -> dict:
         """
@@ -105,20 +197,23 @@ class DataModel():
             "Breast Cancer": "Reflects incidence per 100.000 women.",
             "Prostate Cancer": "Reflects incidence per 100.000 man.",
         }
+        infos.update({unit: description for unit, (_, description) in derived_units.items()})
         return infos
     
+    def _build_screenings(self) -> list[str]:
+        columns = list(self.data.columns[self.data.columns.str.contains("screening")])
+        screenings = []
+        for words in columns:
+            screenings.append(' '.join([word.capitalize() for word in words.split('_')[:2]]) + " Screening")
+        return list(set(screenings))
+    
     def get_screenings(self) -> list[str]:
         """
         Creates a list of easy to read screenings. For filtering purposes.
         Returns:
             _type_: list[str]
         """
-        self.clean_column_names()
-        columns = list(self.data.columns[self.data.columns.str.contains("screening")])
-        screenings = []
-        for words in columns:
-            screenings.append(' '.join([word.capitalize() for word in words.split('_')[:2]]) + " Screening")
-        return list(set(screenings))
+        return list(self._screenings)
     
     def get_years(self) -> list[int]:
         """
@@ -126,7 +221,7 @@ class DataModel():
         Returns:
             _type_: list[int]
         """
-        return list(sorted(set(self.data["year"])))
+        return list(self._years)
     
     def get_countries(self) -> list[str]:
         """
@@ -134,21 +229,309 @@ class DataModel():
         Returns:
             _type_: list[str]
         """
-        return list(sorted(set(self.data["country"])))
+        return list(self._countries)
+    
+    def _load_cube(self, store: ColumnStore, directory: Optional[Path]) -> np.ndarray:
+        # The cube is stored next to the cached columns it is built from, built by the first worker and shared like the data.
+        shape = (len(self._years), len(self._countries), len(self._measures) + len(self._derived))
+        name = f"cube.v{derived_version}"
+        cube = store.load_array(directory, name, mmap=config.SHARED_DATA)
+        if cube is not None and cube.shape == shape:
+            return cube
+        cube = self._build_cube()
+        if directory is not None:
+            store.save_array(directory, name, cube)
+        # The built cube is used directly if it could not be saved, or does not have to be shared.
+        shared = store.load_array(directory, name, mmap=True) if config.SHARED_DATA else None
+        return shared if shared is not None and shared.shape == shape else cube
+    
+    def _build_cube(self) -> np.ndarray:
+        # Countries and years without a row in the dataset keep the value 0, same as the filled NaN values.
+        cube = np.zeros((len(self._years), len(self._countries), len(self._measures)), dtype="float32")
+        year_pos = np.searchsorted(self._years, self.data["year"].to_numpy())
+        country_pos = pd.Categorical(self.data["country"], categories=self._countries).codes
+        cube[year_pos, country_pos] = self.data[self._measures].to_numpy(dtype="float32")
+        # The derived metrics are computed in bulk over all years, countries and incidences.
+        with timed("derived_metrics_build"):
+            derived = derive_metrics(cube, self._measures, self._incidences)
+        return np.concatenate([cube, derived], axis=2)
+    
+    def _build_measure_keys(self) -> dict:
+        # Same matching of cancer type and unit to a column as used by the map filters.
+        columns = self.data.columns
+        keys = {}
+        for cancer_type in self._cancer_types:
+            name = str.lower(cancer_type.split(' ')[0])
+            keys[(cancer_type, "Total Number")] = str(columns[columns.str.contains('_n') & columns.str.contains(name)][0])
+            keys[(cancer_type, "Incidence per 100.000")] = str(columns[columns.str.contains('_incidence') & columns.str.contains(name)][0])
+            # Derived metrics without any value are left out, same as in the table.
+            for unit, (suffix, _) in derived_units.items():
+                measure = f"{keys[(cancer_type, 'Incidence per 100.000')]}_{suffix}"
+                if measure in self._columns:
+                    keys[(cancer_type, unit)] = measure
+        return keys
+    
+    def select(self, year_range: tuple[int, int], countries: list[str], columns: list[str]) -> pd.DataFrame:
+        """
+        Returns year, country and the selected columns for a range of years and a selection of countries.
+        The measures are selected by the query backend, the derived metrics are added from the cube.
+        Returns:
+            _type_: pd.DataFrame
+        """
+        measures = [column for column in columns if column not in self._derived]
+        return self._add_derived(self.backend.select(year_range, countries, measures), columns)
+    
+    def take(self, rows: np.ndarray, columns: list[str]) -> pd.DataFrame:
+        """
+        Returns year, country and the selected columns for rows of the data (by position, e.g. the index of
+        a selection), in the given order. Only these rows are copied.
+        Returns:
+            _type_: pd.DataFrame
+        """
+        names = ["year", "country", *[column for column in columns if column not in self._derived]]
+        df = self.data.iloc[np.asarray(rows, dtype="int64"), [self.data.columns.get_loc(name) for name in names]]
+        return self._add_derived(df, columns)
+    
+    def _add_derived(self, df: pd.DataFrame, columns: list[str]) -> pd.DataFrame:
+        # The derived metrics of the rows are looked up in the cube by year and country.
+        derived = [column for column in columns if column in self._derived]
+        if not derived:
+            return df
+        year_pos = np.searchsorted(self._years, df["year"].to_numpy())
+        country_pos = pd.Categorical(df["country"], categories=self._countries).codes
+        values = self._cube[year_pos, country_pos][:, [self._measure_index[column] for column in derived]]
+        df = df.assign(**{column: values[:, i] for i, column in enumerate(derived)})
+        return df[["year", "country", *columns]]
+    
+    def get_measure(self, cancer_type: str, unit: str) -> str:
+        """
+        Returns the canonical measure key (the clean column name) for a cancer type and unit.
+        Returns:
+            _type_: str
+        """
+        return self._measure_keys[(cancer_type, unit)]
+    
+    def get_value(self, country: str, measure: str, year: int) -> float:
+        """
+        Looks up a single value in the cube.
+        Returns:
+            _type_: float
+        """
+        value = self._cube[self._year_index[int(year)], self._country_index[country], self._measure_index[measure]]
+        return round(float(value), DataModel.decimals)
+    
+    def get_vector(self, measure: str, year: int, countries: list[str]) -> np.ndarray:
+        """
+        Returns the values of one measure in one year, aligned to the given order of countries.
+        Countries that are not part of the dataset get the value 0 (NaN for derived metrics, which have no 0 for missing data).
+        Returns:
+            _type_: np.ndarray
+        """
+        key = tuple(countries)
+        positions = self._alignments.get(key)
+        if positions is None:
+            positions = np.array([self._country_index.get(country, -1) for country in key], dtype="int64")
+            self._alignments[key] = positions
+        
+        values = self._cube[self._year_index[int(year)], :, self._measure_index[measure]]
+        missing = np.nan if measure in self._derived else 0
+        return np.where(positions >= 0, values[positions], missing).astype("float32")
+
+
+#----------------------------------------------------------------
+# The dataset is loaded once per process. Every module and every session reads from this shared instance
+# instead of building its own. When the source files change, reload_util builds new models in the background
+# and swaps them in with set_models, so readers always get a complete model, either the old or the new one.
+#----------------------------------------------------------------
+
+_models = {}
+_models_lock = threading.RLock()
 
 
+def _get_model(name: str, build):
+    model = _models.get(name)
+    if model is None:
+        with _models_lock:
+            model = _models.get(name)
+            if model is None:
+                model = _models[name] = build()
+    return model
+
+
+def set_models(**models) -> None:
+    """
+    Replaces the process-wide models (data, country) at once. A model set to None is built again on its next use.
+    Everything cached from the previous models (result caches, generation caches) is invalidated with the swap.
+    """
+    with _models_lock:
+        for name, model in models.items():
+            if model is None:
+                _models.pop(name, None)
+            else:
+                _models[name] = model
+        # Only after the swap, so that no value computed from the previous models is cached for the new ones.
+        next_data_generation()
+
+
+def loaded_models() -> set[str]:
+    """
+    Names of the process-wide models that have been built so far.
+    Returns:
+        set[str]: Model names.
+    """
+    return set(_models)
+
+
+def get_data_model() -> DataModel:
+    """
+    Returns the process-wide DataModel, loading and cleaning the dataset on the first call.
+    Returns:
+        _type_: DataModel
+    """
+    return _get_model("data", DataModel)
+
     
+class Country(NamedTuple):
+    """
+    One country, as it is spelled and keyed in the centroids, the geo data and the OECD data.
+    """
+    name: str
+    iso: Optional[str]
+    feature_id: Optional[str]
+    data_key: Optional[str]
+    centroid: Optional[tuple[float, float]]
+
+
 class CountryModel():
     """
     This class contains centroid localization for countries.
+    Countries can be looked up by any of their names, aliases, ISO code or feature id, and by coordinate.
     """
     file_path = Path(__file__).parent / "country_centroids.csv"
+    geo_path = Path(__file__).parent / "countries.geojson"
+    
+    # Names used in the OECD data or the geo data, mapped to the name of the country in the centroids.
+    aliases = {
+        "China (People's Republic of)": "China",
+        "Korea": "South Korea",
+        "Slovak Republic": "Slovakia",
+        "Türkiye": "Turkey",
+        "Russia": "Russian Federation",
+        "Republic of Serbia": "Serbia",
+        "Czechia": "Czech Republic",
+        "The Bahamas": "Bahamas",
+        "Brunei": "Brunei Darussalam",
+        "Ivory Coast": "Côte d'Ivoire",
+        "Democratic Republic of the Congo": "Congo DRC",
+        "Republic of the Congo": "Congo",
+        "Macedonia": "North Macedonia",
+        "Swaziland": "Eswatini",
+        "East Timor": "Timor-Leste",
+        "United Republic of Tanzania": "Tanzania",
+        "West Bank": "Palestinian Territory",
+        "French Southern and Antarctic Lands": "French Southern Territories",
+    }
 
-    def __init__(self) -> None:
+    def __init__(self, data_model: Optional[DataModel] = None) -> None:
         # Loarding the data on centroids from a csv in github.
-        self.centroids = pd.read_csv(CountryModel.file_path).iloc[:,0:3]
+        # "NA" is the ISO code of Namibia, not a missing value.
+        self.centroids = pd.read_csv(CountryModel.file_path, keep_default_na=False, na_values=[""]).iloc[:,0:4]
+        
+        # Spatial index over the country polygons, for lookups by coordinate.
+        with open(CountryModel.geo_path, 'r') as f:
+            features = json.load(f)
+        with timed("country_index_build"):
+            self.spatial_index = SpatialIndex(features)
+            # The countries of the data are matched as well, by default those of the shared DataModel.
+            self.countries = self._build_countries(features["features"], (data_model or get_data_model()).get_countries())
+            self.index = self._build_index()
+    
+    def _build_countries(self, features: list[dict], data_countries: list[str]) -> dict:
+        # Records from all three sources are merged on the normalized name, after resolving aliases.
+        records = {}
+        def record(name: str) -> dict:
+            return records.setdefault(self._key(name), {"name": name, "iso": None, "feature_id": None, "data_key": None, "centroid": None, "names": set()})
+        
+        for longitude, latitude, country, iso in self.centroids.itertuples(index=False):
+            entry = record(country)
+            entry.update(name=country, iso=iso if isinstance(iso, str) else None, centroid=(latitude, longitude))
+            entry["names"].add(country)
+        for feature in features:
+            entry = record(feature["properties"]["name"])
+            entry["feature_id"] = feature["id"]
+            entry["names"].add(feature["properties"]["name"])
+        for country in data_countries:
+            entry = record(country)
+            entry["data_key"] = country
+            entry["names"].add(country)
+        
+        # Countries without centroid (e.g. Kosovo) are placed at the center of their largest polygon.
+        for entry in records.values():
+            if entry["centroid"] is None and entry["feature_id"] is not None:
+                entry["centroid"] = self.spatial_index.get_center(entry["feature_id"])
+        
+        return {key: (Country(entry["name"], entry["iso"], entry["feature_id"], entry["data_key"], entry["centroid"]), entry["names"])
+                for key, entry in records.items()}
+    
+    def _build_index(self) -> dict:
+        # Names and aliases come first, codes can not replace a name (ISO codes are not unique in the centroids).
+        index = {}
+        for key, (country, names) in self.countries.items():
+            index[key] = country
+            for name in names:
+                index.setdefault(normalize_name(name), country)
+        for variant, name in CountryModel.aliases.items():
+            if self._key(name) in self.countries:
+                index.setdefault(normalize_name(variant), self.countries[self._key(name)][0])
+        for country, _ in self.countries.values():
+            for code in (country.iso, country.feature_id):
+                if code:
+                    index.setdefault(normalize_name(code), country)
+        return index
+    
+    @staticmethod
+    def _key(name: str) -> str:
+        return normalize_name(CountryModel.aliases.get(name, name))
+    
+    def get_country(self, country: str) -> Optional[Country]:
+        """
+        Looks a country up by name, alias, ISO code or feature id (case and accent insensitive).
+        Returns:
+            Optional[Country]: The country, None if it is unknown.
+        """
+        return self.index.get(normalize_name(country))
     
     def get_centroid(self, country: str) -> tuple:
-        # Get the position for a specific country (reversed order, to match latitude and longitude on maps.)
-        pos = self.centroids[self.centroids["COUNTRY"] == country]
-        return tuple(reversed(pos.values[0][:2]))
\ No newline at end of file
+        # Get the position for a specific country (latitude and longitude, to match positions on maps.)
+        record = self.get_country(country)
+        if record is None or record.centroid is None:
+            raise KeyError(f"No position known for country {country!r}.")
+        return record.centroid
+    
+    def locate(self, lat: float, lon: float) -> Optional[Country]:
+        """
+        Finds the country at a coordinate, e.g. the position of a click on the map.
+        Returns:
+            Optional[Country]: The country, None for points outside of all countries.
+        """
+        feature_id = self.spatial_index.locate(lat, lon)
+        return None if feature_id is None else self.get_country(feature_id)
+
+
+def normalize_name(name: str) -> str:
+    """
+    Normalizes a country name or code for lookups: lower case, without accents, punctuation and repeated spaces.
+    Returns:
+        str: Normalized name.
+    """
+    name = unicodedata.normalize("NFKD", str(name)).encode("ascii", "ignore").decode("ascii").lower()
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", name).split())
+
+
+def get_country_model() -> CountryModel:
+    """
+    Returns the process-wide CountryModel, building its indexes on the first call.
+    Returns:
+        _type_: CountryModel
+    """
+    return _get_model("country", CountryModel)
@@ -0,0 +1,147 @@
+from typing import Optional
+import numpy as np
+
+#----------------------------------------------------------------
+# Derived metrics of the cancer incidences: change to the previous year, moving average, ranking and percentile
+# of the countries in every year, and screening per incidence. They are computed at once for every year, country
+# and incidence with numpy on the cube of the DataModel, and stored with it, so renders only look values up.
+# Missing values are 0 in the data (filled NaN values). Derived values that cannot be computed are NaN.
+#----------------------------------------------------------------
+
+# Map units of the derived metrics, with the suffix of their columns (appended to the incidence column)
+# and a description for the map footer.
+units = {
+    "Incidence change to previous year (%)": ("change", "Change of the incidence per 100.000 compared to the previous year, in %."),
+    "Incidence 3-year average": ("3y_average", "Average incidence per 100.000 of the year and the two years before."),
+    "Incidence rank": ("rank", "Rank of the incidence per 100.000 among the countries with data in that year, 1 is the highest."),
+    "Incidence percentile": ("percentile", "Share of the countries with data in that year that have a lower incidence per 100.000, in %."),
+    "Screening per incidence": ("screening_ratio", "Screening rate (in %) divided by the incidence per 100.000, times 100. Only available for breast and colorectal cancer."),
+}
+
+# Number of years in the moving average.
+window = 3
+
+# Version of the computation, part of the name of the cached cube. Increased with every change of the metrics,
+# so that a cube cached with the previous metrics is built again.
+version = 1
+
+
+def derived_columns(incidences: list[str]) -> list[str]:
+    """
+    Names of the derived columns for the incidence columns, in the order of derive_metrics.
+    Returns:
+        list[str]: Column names.
+    """
+    return [f"{incidence}_{suffix}" for incidence in incidences for suffix, _ in units.values()]
+
+
+def screening_column(incidence: str, measures: list[str]) -> Optional[str]:
+    """
+    The screening column compared to an incidence column: the first one of the same cancer, which is
+    the one for the whole screened population (e.g. colorectal screening of females and males).
+    Returns:
+        Optional[str]: Column name, None for cancers without screening.
+    """
+    prefix = incidence.split("_incidence")[0] + "_screening"
+    return next((measure for measure in measures if measure.startswith(prefix)), None)
+
+
+def derive_metrics(cube: np.ndarray, measures: list[str], incidences: list[str]) -> np.ndarray:
+    """
+    Computes all derived metrics from a cube indexed by (year, country, measure), with the years in order.
+    Returns:
+        np.ndarray: Cube indexed by (year, country, derived column), in the order of derived_columns.
+    """
+    index = {measure: i for i, measure in enumerate(measures)}
+    values = _missing_as_nan(cube[:, :, [index[incidence] for incidence in incidences]])
+
+    screenings = np.full_like(values, np.nan)
+    for i, incidence in enumerate(incidences):
+        screening = screening_column(incidence, measures)
+        if screening is not None:
+            screenings[:, :, i] = _missing_as_nan(cube[:, :, index[screening]])
+
+    metrics = {
+        "change": year_over_year(values),
+        "3y_average": moving_average(values, window),
+        "rank": rankings(values),
+        "percentile": percentiles(values),
+        # Scaled by 100, so the ratio keeps its precision with the one decimal shown in the dashboard.
+        "screening_ratio": screenings / values * 100,
+    }
+    # (year, country, incidence, metric) flattened to one derived column per incidence and metric.
+    derived = np.stack([metrics[suffix] for suffix, _ in units.values()], axis=-1)
+    return derived.reshape(*values.shape[:2], -1).astype("float32")
+
+
+def year_over_year(values: np.ndarray) -> np.ndarray:
+    """
+    Change to the previous year in %, along the first axis.
+    Returns:
+        np.ndarray: Changes, NaN in the first year and where a value is missing or the previous value is 0.
+    """
+    change = np.full_like(values, np.nan)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        change[1:] = (values[1:] - values[:-1]) / values[:-1] * 100
+    change[~np.isfinite(change)] = np.nan
+    return change
+
+
+def moving_average(values: np.ndarray, years: int) -> np.ndarray:
+    """
+    Average of the values of a year and the years before it (along the first axis), skipping missing years.
+    Returns:
+        np.ndarray: Averages, NaN where the value of the year itself is missing.
+    """
+    present = ~np.isnan(values)
+    totals = np.cumsum(np.where(present, values, 0), axis=0)
+    counts = np.cumsum(present, axis=0)
+    totals[years:] = totals[years:] - totals[:-years]
+    counts[years:] = counts[years:] - counts[:-years]
+    with np.errstate(invalid="ignore"):
+        return np.where(present, totals / counts, np.nan)
+
+
+def rankings(values: np.ndarray) -> np.ndarray:
+    """
+    Rank of every country (second axis) in its year, 1 for the highest value. Equal values share the best rank.
+    Returns:
+        np.ndarray: Ranks, NaN where the value is missing.
+    """
+    return _min_ranks(-values)
+
+
+def percentiles(values: np.ndarray) -> np.ndarray:
+    """
+    Share of the other countries (second axis) with data in the same year that have a lower value, in %.
+    Returns:
+        np.ndarray: Percentiles from 0 (lowest) to 100 (highest), NaN where the value is missing.
+    """
+    lower = _min_ranks(values) - 1
+    others = np.maximum((~np.isnan(values)).sum(axis=1, keepdims=True) - 1, 1)
+    return lower / others * 100
+
+
+def _missing_as_nan(values: np.ndarray) -> np.ndarray:
+    values = values.astype("float64")
+    values[values == 0] = np.nan
+    return values
+
+
+def _min_ranks(keys: np.ndarray) -> np.ndarray:
+    # Ranks along the second axis in ascending order of the keys. Missing keys are sorted last and get NaN.
+    present = ~np.isnan(keys)
+    keys = np.where(present, keys, np.inf)
+    order = np.argsort(keys, axis=1, kind="stable")
+    ordered = np.take_along_axis(keys, order, axis=1)
+
+    # Every run of equal keys gets the position of its first element.
+    positions = np.broadcast_to(np.arange(keys.shape[1]).reshape(1, -1, *[1] * (keys.ndim - 2)), keys.shape)
+    starts = np.ones(keys.shape, dtype=bool)
+    starts[:, 1:] = ordered[:, 1:] != ordered[:, :-1]
+    ordered_ranks = np.maximum.accumulate(np.where(starts, positions, 0), axis=1) + 1
+
+    ranks = np.empty(keys.shape, dtype="float64")
+    np.put_along_axis(ranks, order, ordered_ranks, axis=1)
+    ranks[~present] = np.nan
+    return ranks
@@ -0,0 +1,159 @@
+import io
+import tempfile
+import zlib
+from importlib.util import find_spec
+from typing import Iterator, NamedTuple, Optional
+import numpy as np
+import pandas as pd
+from metrics_util import metrics
+from data_util import get_data_model
+from table_util import present_rows, search_rows, sort_rows
+
+#----------------------------------------------------------------
+# Export of the table selection as a file. The rows are taken from the data, presented and encoded chunk by chunk,
+# and every encoded chunk is sent on as soon as it is ready, so an export never holds the whole file in memory.
+# Parquet (pyarrow) and Excel (openpyxl) are optional and only offered when their package is installed.
+#----------------------------------------------------------------
+
+class ExportFormat(NamedTuple):
+    """
+    A file format for exports, with the package it needs (None for the standard library).
+    """
+    label: str
+    extension: str
+    media_type: str
+    package: Optional[str]
+
+
+formats = {
+    "csv": ExportFormat("CSV", "csv", "text/csv", None),
+    "csv.gz": ExportFormat("CSV (gzip)", "csv.gz", "application/gzip", None),
+    "parquet": ExportFormat("Parquet", "parquet", "application/vnd.apache.parquet", "pyarrow"),
+    "xlsx": ExportFormat("Excel", "xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "openpyxl"),
+}
+
+
+def available_formats() -> dict[str, str]:
+    """
+    The formats that can be exported in this environment, with their labels.
+    Returns:
+        dict[str, str]: Labels by format.
+    """
+    return {name: fmt.label for name, fmt in formats.items() if fmt.package is None or find_spec(fmt.package) is not None}
+
+
+def export_frames(years: tuple[int, int], countries: list[str], columns: list[str], search: str, sort: str, descending: bool,
+                  chunk_rows: int) -> Iterator[pd.DataFrame]:
+    """
+    Rows of the table selection (all pages), as shown in the table, in chunks. Yields at least one (empty) chunk.
+    Returns:
+        Iterator[pd.DataFrame]: Chunks of rows.
+    """
+    # Only the positions of the selected rows (with year, country and the sort column) are selected at once,
+    # the values of the columns are taken chunk by chunk. Nothing is added to the result caches of the table.
+    dm = get_data_model()
+    rows = dm.select(years, countries, [sort] if sort in columns else [])
+    if search.strip():
+        matches = [search_rows(dm.take(rows.index[start:start + chunk_rows], columns), search).index
+                   for start in range(0, len(rows), chunk_rows)]
+        rows = rows.loc[np.concatenate(matches)] if matches else rows
+    # Same order as the table: the rows of the data in their order, sorted stably.
+    rows = sort_rows(rows, sort, descending)
+    for start in range(0, max(len(rows), 1), chunk_rows):
+        yield present_rows(dm.take(rows.index[start:start + chunk_rows], columns), columns)
+
+
+def export_chunks(fmt: str, frames: Iterator[pd.DataFrame]) -> Iterator[bytes]:
+    """
+    Encodes chunks of rows into the bytes of a file in the given format.
+    Returns:
+        Iterator[bytes]: Consecutive parts of the file.
+    """
+    if fmt == "csv":
+        chunks = _csv(frames)
+    elif fmt == "csv.gz":
+        chunks = _gzip(_csv(frames))
+    elif fmt == "parquet":
+        chunks = _parquet(frames)
+    elif fmt == "xlsx":
+        chunks = _xlsx(frames)
+    else:
+        raise ValueError(f"Unknown export format {fmt!r}, use {', '.join(formats)}.")
+
+    for chunk in chunks:
+        if chunk:
+            metrics.observe("export_chunk_bytes", len(chunk), format=fmt)
+            yield chunk
+
+
+def _csv(frames: Iterator[pd.DataFrame]) -> Iterator[bytes]:
+    for i, df in enumerate(frames):
+        yield df.to_csv(index=False, header=(i == 0)).encode("utf-8")
+
+
+def _gzip(chunks: Iterator[bytes]) -> Iterator[bytes]:
+    # wbits 31 writes the gzip container, so the result can be opened like any .gz file.
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        yield compressor.compress(chunk)
+    yield compressor.flush()
+
+
+class _Sink(io.RawIOBase):
+    # Collects what a writer writes, until it is drained and sent.
+    def __init__(self) -> None:
+        self.parts = []
+        self.position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def drain(self) -> bytes:
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+def _parquet(frames: Iterator[pd.DataFrame]) -> Iterator[bytes]:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # Every chunk becomes one row group, which is sent as soon as it is written.
+    sink = _Sink()
+    writer = None
+    for df in frames:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(sink, table.schema, compression="zstd")
+        writer.write_table(table)
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def _xlsx(frames: Iterator[pd.DataFrame]) -> Iterator[bytes]:
+    from openpyxl import Workbook
+
+    # An xlsx file is a zip archive, which can only be sent once it is complete. The write-only workbook
+    # keeps the rows in temporary files instead of memory, and the archive is spooled to disk as well.
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Data")
+    for i, df in enumerate(frames):
+        if i == 0:
+            sheet.append(list(df.columns))
+        for row in df.to_numpy(dtype=object).tolist():
+            # Missing values (derived metrics) are left empty, Excel has no NaN.
+            sheet.append([None if value != value else str(value) if not isinstance(value, (int, float)) else value for value in row])
+    with tempfile.TemporaryFile() as f:
+        workbook.save(f)
+        f.seek(0)
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            yield chunk
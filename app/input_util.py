@@ -0,0 +1,94 @@
+import time
+from typing import Callable, Optional, TypeVar
+from shiny import reactive, ui
+from metrics_util import metrics
+import config
+
+#----------------------------------------------------------------
+# Coalescing filter inputs before they reach the renders. Adding five countries one by one, or stepping through
+# the years of a select with the keyboard, should lead to one render of the final state instead of one per change.
+#----------------------------------------------------------------
+
+T = TypeVar("T")
+
+
+def debounce(name: str, seconds: float, read: Callable[[], T]) -> Callable[[], T]:
+    """
+    Reactive calculation with the value of read, which only changes once read has not changed for the given seconds.
+    The first value is available immediately. Must be called within a session (e.g. in a module server).
+    Returns:
+        Callable[[], T]: Debounced reactive calculation.
+    """
+    # Time at which the latest change counts as settled, and a counter that is increased when it has.
+    due = reactive.Value(None)
+    settled = reactive.Value(0)
+    started = []
+
+    @reactive.effect
+    def watch():
+        read()
+        if not started:
+            started.append(True)
+            return
+        with reactive.isolate():
+            if due() is not None:
+                metrics.inc("inputs_coalesced", input=name)
+        due.set(time.monotonic() + seconds)
+
+    @reactive.effect
+    def fire():
+        target = due()
+        if target is None:
+            return
+        remaining = target - time.monotonic()
+        if remaining > 0:
+            reactive.invalidate_later(remaining)
+            return
+        due.set(None)
+        with reactive.isolate():
+            settled.set(settled() + 1)
+
+    @reactive.calc
+    @reactive.event(settled, ignore_none=False)
+    def value():
+        return read()
+
+    return value
+
+
+def on_apply(button: Callable[[], int], read: Callable[[], T]) -> Callable[[], T]:
+    """
+    Reactive calculation with the value of read, which only changes when the button is pressed.
+    The first value is available immediately.
+    Returns:
+        Callable[[], T]: Reactive calculation.
+    """
+    @reactive.calc
+    @reactive.event(button, ignore_none=False)
+    def value():
+        return read()
+
+    return value
+
+
+def apply_button(id: str):
+    """
+    The "Apply filters" button of a sidebar, only shown if filters are applied with a button (APPLY_FILTERS).
+    Returns:
+        _type_: Action button, or None.
+    """
+    return ui.input_action_button(id, "Apply filters", class_="btn-primary") if config.APPLY_FILTERS else None
+
+
+def coalesce_inputs(name: str, read: Callable[[], T], button: Optional[Callable[[], int]] = None) -> Callable[[], T]:
+    """
+    Filters as the renders should see them, depending on the settings: only applied with the button (APPLY_FILTERS),
+    debounced by FILTER_DEBOUNCE_SECONDS, or passed on with every change.
+    Returns:
+        Callable[[], T]: Reactive calculation with the filters.
+    """
+    if button is not None and config.APPLY_FILTERS:
+        return on_apply(button, read)
+    if config.FILTER_DEBOUNCE_SECONDS > 0:
+        return debounce(name, config.FILTER_DEBOUNCE_SECONDS, read)
+    return reactive.calc(read)
@@ -0,0 +1,67 @@
+from ipyleaflet import Choropleth
+from traitlets import observe
+from map_util import ChoroplethData, style_features, value_bounds
+from metrics_util import timed
+
+#----------------------------------------------------------------
+# Choropleth layer that can be updated in place. Changing data, value_min and value_max on a plain
+# Choropleth restyles (and deep copies) the geometry once per trait and sends one message each.
+#----------------------------------------------------------------
+
+class ChoroplethLayer(Choropleth):
+    """
+    Choropleth layer with an update method that applies new data and color bounds in one step.
+    Features are styled by style_features, a custom style_callback is not supported.
+    """
+
+    _batch_update = False
+
+    @observe('style', 'style_callback', 'value_min', 'value_max', 'nan_color', 'nan_opacity', 'default_opacity', 'geo_data', 'choro_data', 'colormap', 'key_on')
+    def _update_data(self, change):
+        # While update() is running, the data is only rebuilt once at the end.
+        if not self._batch_update:
+            self.data = self._get_data()
+
+    def _get_data(self):
+        if not self.geo_data:
+            return {}
+        if self.value_min is None or self.value_max is None:
+            value_min, value_max = value_bounds(self.choro_data)
+            self.value_min = value_min if self.value_min is None else self.value_min
+            self.value_max = value_max if self.value_max is None else self.value_max
+        return style_features(self.geo_data, self.choro_data, self.colormap, self.value_min, self.value_max,
+                              self.nan_color, self.nan_opacity, self.default_opacity, self.key_on)
+
+    def update(self, choro_data: dict) -> None:
+        """
+        Replaces the choropleth data and rescales the colormap to the new values.
+        The new style is sent to the browser as a single message.
+        """
+        value_min, value_max = value_bounds(choro_data)
+        with self.hold_sync():
+            self._batch_update = True
+            try:
+                self.value_min = value_min
+                self.value_max = value_max
+                self.choro_data = choro_data
+            finally:
+                self._batch_update = False
+            with timed("choropleth_style"):
+                self.data = self._get_data()
+
+    def apply(self, choropleth: ChoroplethData) -> None:
+        """
+        Shows choropleth data that has already been styled, e.g. in a worker. Nothing is recomputed here,
+        unless the layer matches features by another key_on than the feature id the data was styled with.
+        The new style is sent to the browser as a single message.
+        """
+        with self.hold_sync():
+            self._batch_update = True
+            try:
+                self.geo_data = choropleth.geo_data
+                self.value_min = choropleth.value_min
+                self.value_max = choropleth.value_max
+                self.choro_data = choropleth.choro_data
+            finally:
+                self._batch_update = False
+            self.data = choropleth.data if self.key_on == "id" else self._get_data()
@@ -1,50 +1,290 @@
 import pandas as pd
 import json
+from functools import lru_cache
+from math import isnan
 from pathlib import Path
-from data_util import DataModel
+from typing import TYPE_CHECKING, NamedTuple, Optional
+from cache_util import ResultCache, generation_cache
+from data_util import get_country_model, get_data_model
+from metrics_util import timed
+from store_util import FileCache
+from topo_util import Topology
+import config
+
+if TYPE_CHECKING:
+    from branca.colormap import ColorMap
 
 #----------------------------------------------------------------
 # Contains helper functions for the tranformation of geoJSON for map layers.
 #----------------------------------------------------------------
 
 class GeoJTransformer():
-    
-    # Loading data from the datamodel, as this needs to be joined with the geo data.
-    dm = DataModel()
-    dm_data = dm.get_data()
-    
-    def __init__(self) -> None:
-        # get the polygon data for countries from github.
-        json_path = Path(__file__).parent / "countries.geojson"
-        with open(json_path, 'r') as f:
-            self.data = json.load(f)
-        
-    def get_geo_data(self) -> pd.DataFrame:
+
+    json_path = Path(__file__).parent / "countries.geojson"
+
+    # Zoom levels that get their own simplified geometry. Beyond the last one the full geometry is used.
+    detail_zooms = (2, 4, 6, 8)
+
+    def get_geo_data(self, zoom: Optional[float] = None) -> pd.DataFrame:
         """
-        Returning the dataframe stored in the data attribute.
+        Returning the polygon data for countries, parsed once per process and shared by all sessions.
+        If a zoom is given, the geometry is simplified to the level of detail visible at that zoom.
         Returns:
             pd.DataFrame: DataFrame containg the polygon data for each country.
         """
-        return self.data
-    
+        if zoom is None:
+            return load_geo_data()
+        return load_geo_level(detail_level(zoom))
+
     def get_choro_data(self) -> pd.DataFrame:
         """
         Merges two DataFrames, one with a full set of countries and their abbreviations, and another with a subset of countries and their cancer data.
+        The merge is only done once per process, the returned DataFrame is shared and must not be modified in place.
         Returns:
             pd.DataFrame: Merged DataFrame with country information on cancer and country name/abbreviation.
         """
-        
-        # change json into dataframe and only keep the abbreviated Country name and the full country name.
-        geo_sliced = pd.json_normalize(self.data["features"]).iloc[:, 1:3]
-        
-        # merge geo data and shaped data from datamodel, while keeping all the abbreviated country names.
-        choro_data = pd.merge(left=geo_sliced, 
-                              right=GeoJTransformer.dm_data, 
-                              left_on="properties.name", 
-                              right_on="country", 
-                              how="left")
-        
-        # Fill everything that has no value due to the left-join.
-        choro_data.fillna(0, inplace=True)
-        
-        return choro_data
\ No newline at end of file
+        return build_choro_data()
+
+    def get_choro_dict(self, year: int, measure: str) -> dict:
+        """
+        Returns the choropleth data for one year and measure, keyed by feature id.
+        Returns:
+            dict: Values for every feature of the geo data.
+        """
+        year = int(year)
+        return dict(choro_cache.get_or_compute((year, measure), lambda: build_choro_dict(year, measure)))
+
+
+#----------------------------------------------------------------
+# The geo data and everything derived from it only changes when the source files are reloaded (see reload_util).
+# It is therefore built once per generation of the models, and the choropleth data per (year, measure) is kept in a shared
+# result cache. Both are invalidated by the swap of the models itself, so a render during a reload never mixes the two.
+#----------------------------------------------------------------
+
+@generation_cache
+@timed("geo_load")
+def load_geo_data() -> dict:
+    """
+    Reads the polygon data for all countries from the geojson file.
+    Returns:
+        dict: Parsed geojson.
+    """
+    with open(GeoJTransformer.json_path, 'r') as f:
+        return json.load(f)
+
+
+def detail_level(zoom: float) -> Optional[int]:
+    """
+    Picks the level of detail for a zoom: the first detail zoom that is not below the map zoom.
+    Returns:
+        Optional[int]: The detail zoom, or None for the full geometry.
+    """
+    for level in GeoJTransformer.detail_zooms:
+        if zoom <= level:
+            return level
+    return None
+
+
+@generation_cache
+def load_topology() -> Topology:
+    """
+    Converts the geo data into a topology with quantized coordinates and shared borders.
+    The topology is cached on disk, built by the first worker and memory-mapped by all others (SHARED_DATA).
+    Returns:
+        Topology: Topology of all countries.
+    """
+    json_path = GeoJTransformer.json_path
+    cache = FileCache(json_path, json_path.parent / ".cache" / json_path.stem)
+    directory = cache.current()
+    if directory is None:
+        with cache.lock():
+            directory = cache.current()
+            if directory is None:
+                with timed("geo_topology_build"):
+                    topology = Topology(load_geo_data())
+                directory = cache.publish(topology.save)
+                if directory is None:
+                    return topology
+    try:
+        with timed("geo_topology_load"):
+            return Topology.load(directory, mmap=config.SHARED_DATA)
+    except (OSError, ValueError, KeyError):
+        with timed("geo_topology_build"):
+            return Topology(load_geo_data())
+
+
+@generation_cache
+@timed("geo_simplify")
+def load_geo_level(level: Optional[int]) -> dict:
+    """
+    Builds the geo data for one level of detail. Arcs are simplified by one pixel at the zoom of the level.
+    Returns:
+        dict: Simplified geojson.
+    """
+    tolerance = 0.0 if level is None else 360 / (256 * 2 ** level)
+    loaded_levels.add(level)
+    return load_topology().to_geojson(tolerance)
+
+
+# Levels of detail built in this process, so that they can be built again right after a reload.
+loaded_levels = set()
+
+
+@generation_cache
+def load_features() -> tuple[tuple[str, ...], tuple[str, ...]]:
+    """
+    Maps every feature id to its country name, in the order of the geo data.
+    Returns:
+        tuple: Feature ids and country names.
+    """
+    # Read from the topology, which has the same features in the same order, so the geojson is not parsed for it.
+    features = load_topology().features
+    ids = tuple(feature["id"] for feature in features)
+    names = tuple(feature["properties"]["name"] for feature in features)
+    return ids, names
+
+
+@generation_cache
+def load_data_keys() -> tuple[Optional[str], ...]:
+    """
+    Maps every feature to the country key of the OECD data, which is spelled differently for some countries (e.g. Türkiye).
+    Returns:
+        tuple: Country keys in the order of the geo data, None for countries without data.
+    """
+    cm = get_country_model()
+    ids, _ = load_features()
+    return tuple(getattr(cm.get_country(feature_id), "data_key", None) for feature_id in ids)
+
+
+@generation_cache
+@timed("choro_join")
+def build_choro_data() -> pd.DataFrame:
+    """
+    Joins the feature ids and country names with the cancer data of the datamodel.
+    Returns:
+        pd.DataFrame: Merged DataFrame with country information on cancer and country name/abbreviation.
+    """
+    # change json into dataframe and only keep the abbreviated Country name and the full country name.
+    geo_sliced = pd.json_normalize(load_geo_data()["features"]).iloc[:, 1:3]
+
+    # merge geo data and shaped data from datamodel, while keeping all the abbreviated country names.
+    choro_data = pd.merge(left=geo_sliced,
+                          right=get_data_model().get_data(),
+                          left_on="properties.name",
+                          right_on="country",
+                          how="left")
+
+    # Fill everything that has no value due to the left-join. The categorical country column is left as is.
+    choro_data.fillna({column: 0 for column in choro_data.columns if column != "country"}, inplace=True)
+
+    return choro_data
+
+
+choro_cache = ResultCache("choro_data", config.CACHE_MAX_BYTES)
+
+
+@timed("choro_dict")
+def build_choro_dict(year: int, measure: str) -> dict:
+    """
+    Builds the choropleth data for one year and measure, using the cube of the datamodel.
+    Returns:
+        dict: Values for every feature of the geo data, keyed by feature id.
+    """
+    ids, _ = load_features()
+    values = get_data_model().get_vector(measure, year, load_data_keys())
+    return dict(zip(ids, values.tolist()))
+
+
+#----------------------------------------------------------------
+# Styling the geo data with the choropleth colors. This is the heavy part of a map update, and only depends
+# on its arguments, so that it can also run in a worker pool. The result is applied to the layer afterwards.
+#----------------------------------------------------------------
+
+@lru_cache(maxsize=None)
+def get_colormap() -> "ColorMap":
+    """
+    Colormap of the choropleth layer on the map. branca is only imported when the first map is styled.
+    Returns:
+        ColorMap: Linear colormap.
+    """
+    from branca.colormap import linear
+    return linear.Purples_04
+
+
+def style_features(geo_data: dict, choro_data: dict, colormap: "ColorMap", value_min: float, value_max: float,
+                   nan_color: str = "black", nan_opacity: float = 0.4, default_opacity: float = 1.0, key_on: str = "id") -> dict:
+    """
+    Adds the choropleth style to every feature, with the same colors as the default style of ipyleaflet.
+    The value of a feature is looked up in choro_data by the feature key key_on, as in ipyleaflet.
+    The geometry is shared with geo_data instead of being deep copied, it must not be modified in place.
+    Returns:
+        dict: Styled geojson.
+    """
+    colormap = colormap.scale(value_min, value_max)
+    features = []
+    for feature in geo_data["features"]:
+        value = choro_data[feature[key_on]]
+        style = dict(
+            fillColor=nan_color if isnan(value) else colormap(value),
+            fillOpacity=nan_opacity if isnan(value) else default_opacity,
+            color="black",
+            weight=0.9,
+        )
+        features.append({**feature, "properties": {**feature["properties"], "style": style}})
+    return {**geo_data, "features": features}
+
+
+class ChoroplethData(NamedTuple):
+    """
+    Everything a choropleth layer needs to show one year and measure at one level of detail.
+    """
+    level: Optional[int]
+    year: int
+    cancer_type: str
+    unit: str
+    measure: str
+    geo_data: dict
+    choro_data: dict
+    value_min: float
+    value_max: float
+    data: dict
+
+
+def build_choropleth(level: Optional[int], year: int, cancer_type: str, unit: str) -> ChoroplethData:
+    """
+    Prepares (and styles) the choropleth for the filters of the map, at the level of detail of the zoom.
+    Returns:
+        ChoroplethData: Data to apply to the choropleth layer.
+    """
+    measure = get_data_model().get_measure(cancer_type, unit)
+    geo_data = load_geo_level(level)
+    choro_data = GeoJTransformer().get_choro_dict(year, measure)
+    value_min, value_max = value_bounds(choro_data)
+    with timed("choropleth_style"):
+        data = style_features(geo_data, choro_data, get_colormap(), value_min, value_max)
+    return ChoroplethData(level, int(year), cancer_type, unit, measure, geo_data, choro_data, value_min, value_max, data)
+
+
+def value_bounds(choro_data: dict) -> tuple[float, float]:
+    """
+    Minimum and maximum of the choropleth data, ignoring NaN values.
+    Returns:
+        tuple[float, float]: Bounds used to scale the colormap, (0, 0) if there are no values.
+    """
+    values = [value for value in choro_data.values() if not isnan(value)]
+    return (min(values), max(values)) if values else (0.0, 0.0)
+
+
+def clear_caches() -> list[Optional[int]]:
+    """
+    Frees everything derived from the geo data and the datamodel, after the source files were reloaded.
+    The swap of the models already invalidated it, this only releases the memory of the previous generation.
+    Returns:
+        list[Optional[int]]: The levels of detail that were built before, to build them again.
+    """
+    levels = list(loaded_levels)
+    loaded_levels.clear()
+    for cached in (load_geo_data, load_topology, load_geo_level, load_features, load_data_keys, build_choro_data):
+        cached.cache_clear()
+    choro_cache.clear()
+    return levels
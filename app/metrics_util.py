@@ -0,0 +1,210 @@
+import cProfile
+import io
+import json
+import logging
+import pstats
+import random
+import threading
+import time
+from contextlib import ContextDecorator
+from pathlib import Path
+from typing import Any, Callable, Optional, Union
+from shiny import reactive
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse
+from cache_util import caches
+import config
+
+#----------------------------------------------------------------
+# Instrumentation of the dashboard: render times, stage times, payload sizes and invalidation counts.
+# Metrics are kept in memory per process and can be exposed in the Prometheus text format on /metrics (METRICS_ENDPOINT),
+# optionally written to the log in regular intervals.
+#----------------------------------------------------------------
+
+logger = logging.getLogger("dashboard.metrics")
+
+
+class Metrics():
+    """
+    The Metrics class collects counters and summaries (count, sum and max) with labels.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.summaries = {}
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        """
+        Increases a counter.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """
+        Adds an observation (e.g. a duration or a size) to a summary.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            count, total, maximum = self.summaries.get(key, (0, 0.0, 0.0))
+            self.summaries[key] = (count + 1, total + value, max(maximum, value))
+
+    def snapshot(self) -> dict:
+        """
+        Copy of all metrics, including the statistics of the result caches.
+        Returns:
+            dict: Counters, summaries and caches.
+        """
+        with self.lock:
+            counters = [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in self.counters.items()]
+            summaries = [{"name": name, "labels": dict(labels), "count": count, "sum": total, "max": maximum}
+                         for (name, labels), (count, total, maximum) in self.summaries.items()]
+        return {"counters": counters, "summaries": summaries, "caches": {name: cache.stats() for name, cache in caches.items()}}
+
+    def to_prometheus(self) -> str:
+        """
+        All metrics in the Prometheus text format.
+        Returns:
+            str: Text for the /metrics endpoint.
+        """
+        snapshot = self.snapshot()
+
+        # Samples are grouped by metric family, as required by the text format.
+        families = {}
+
+        def add(family: str, kind: str, labels: dict, value: float, sample: Optional[str] = None) -> None:
+            label_text = ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+            name = sample or family
+            families.setdefault(family, (kind, []))[1].append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+        for counter in sorted(snapshot["counters"], key=lambda c: c["name"]):
+            add(f"dashboard_{counter['name']}_total", "counter", counter["labels"], counter["value"])
+        for summary in sorted(snapshot["summaries"], key=lambda s: s["name"]):
+            family = f"dashboard_{summary['name']}"
+            add(family, "summary", summary["labels"], summary["count"], sample=f"{family}_count")
+            add(family, "summary", summary["labels"], summary["sum"], sample=f"{family}_sum")
+            add(f"{family}_max", "gauge", summary["labels"], summary["max"])
+        for cache, stats in snapshot["caches"].items():
+            for key in ("hits", "misses", "evictions"):
+                add(f"dashboard_cache_{key}_total", "counter", {"cache": cache}, stats[key])
+            for key in ("entries", "bytes", "max_bytes"):
+                add(f"dashboard_cache_{key}", "gauge", {"cache": cache}, stats[key])
+
+        lines = []
+        for family, (kind, samples) in families.items():
+            lines.append(f"# TYPE {family} {kind}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# Metrics of this process.
+metrics = Metrics()
+
+
+class timed(ContextDecorator):
+    """
+    Measures the wall time of a stage, as context manager or decorator, in the summary stage_seconds.
+    """
+
+    def __init__(self, stage: str, **labels) -> None:
+        self.stage = stage
+        self.labels = labels
+
+    def _recreate_cm(self):
+        # Used as decorator, every call gets its own instance, so that concurrent calls do not share their start time.
+        return timed(self.stage, **self.labels)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        metrics.observe("stage_seconds", time.perf_counter() - self.start, stage=self.stage, **self.labels)
+        return False
+
+
+class render_span(ContextDecorator):
+    """
+    Instruments one run of a render function (or reactive effect): counts the invalidation, measures the wall time
+    and, if enabled, profiles it. Slow renders are logged together with their context (e.g. the selected filters).
+    """
+
+    def __init__(self, output: str, context: Optional[Callable[[], dict]] = None) -> None:
+        self.output = output
+        self.context = context
+
+    def _recreate_cm(self):
+        return render_span(self.output, self.context)
+
+    def __enter__(self):
+        metrics.inc("invalidations", output=self.output)
+        self.profiler = cProfile.Profile() if config.PROFILE_RENDERS else None
+        self.start = time.perf_counter()
+        if self.profiler is not None:
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc):
+        if self.profiler is not None:
+            self.profiler.disable()
+        elapsed = time.perf_counter() - self.start
+        metrics.observe("render_seconds", elapsed, output=self.output)
+        if elapsed >= config.SLOW_RENDER_SECONDS:
+            # Reading the context must not make the render depend on more inputs.
+            with reactive.isolate():
+                context = self.context() if self.context is not None else {}
+            logger.warning(json.dumps({"event": "slow_render", "output": self.output, "seconds": round(elapsed, 4), **_jsonable(context)}))
+        if self.profiler is not None:
+            _write_profile(self.profiler, self.output)
+        return False
+
+
+def record_payload(output: str, payload: Union[Any, Callable[[], Any]]) -> None:
+    """
+    Records the size of the JSON sent to the browser for an output, for a sample of the renders (METRICS_PAYLOAD_SAMPLE).
+    The payload can be passed as a function, so that it is only produced when it is measured.
+    """
+    if config.METRICS_PAYLOAD_SAMPLE <= 0 or random.random() >= config.METRICS_PAYLOAD_SAMPLE:
+        return
+    payload = payload() if callable(payload) else payload
+    size = len(payload) if isinstance(payload, str) else len(json.dumps(payload))
+    metrics.observe("payload_bytes", size, output=output)
+
+
+def _jsonable(context: dict) -> dict:
+    return {key: value if isinstance(value, (int, float, str, bool)) or value is None else str(value) for key, value in context.items()}
+
+
+def _write_profile(profiler: cProfile.Profile, output: str) -> None:
+    # Profiles are written as .prof files (for snakeviz, pstats, ...) and summarized in the log.
+    directory = Path(config.PROFILE_DIR)
+    directory.mkdir(parents=True, exist_ok=True)
+    profiler.dump_stats(directory / f"{output}-{time.strftime('%Y%m%d-%H%M%S')}-{time.perf_counter_ns()}.prof")
+    text = io.StringIO()
+    pstats.Stats(profiler, stream=text).sort_stats("cumulative").print_stats(10)
+    logger.info(text.getvalue())
+
+
+async def metrics_endpoint(request: Request) -> PlainTextResponse:
+    """
+    Starlette endpoint returning the metrics in the Prometheus text format.
+    """
+    return PlainTextResponse(metrics.to_prometheus(), media_type="text/plain; version=0.0.4")
+
+
+def start_metrics_log(interval: float) -> None:
+    """
+    Writes a snapshot of all metrics as one JSON line to the log every interval (in seconds).
+    """
+    def run() -> None:
+        while True:
+            time.sleep(interval)
+            logger.info(json.dumps({"event": "metrics", **metrics.snapshot()}))
+
+    threading.Thread(target=run, name="metrics-log", daemon=True).start()
@@ -0,0 +1,254 @@
+import logging
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Optional
+import numpy as np
+import pandas as pd
+from store_util import FileCache
+
+#----------------------------------------------------------------
+# Query backends for the selections of the table (range of years, countries and columns).
+# The pandas backend resolves selections with a row index over the in-memory data. The embedded engines
+# (SQLite from the standard library, DuckDB if installed) push the filters down as predicates and projections
+# into a database file next to the csv. The DataModel still holds all data in memory (the map and the exports
+# read it directly), so the engines change how selections are resolved, not the memory of a worker.
+# The database is built once per version of the csv and opened read-only by every worker process.
+#----------------------------------------------------------------
+
+logger = logging.getLogger("dashboard.query")
+
+
+class QueryBackend(ABC):
+    """
+    The QueryBackend class is the interface of the backends. Every backend returns the rows in the order of the data,
+    with the index (row positions) and data types of the data.
+    """
+    name: str
+
+    def __init__(self, data: pd.DataFrame) -> None:
+        self.data = data
+
+    @abstractmethod
+    def select(self, year_range: tuple[int, int], countries: list[str], columns: list[str]) -> pd.DataFrame:
+        """
+        Returns year, country and the selected columns for a range of years and a selection of countries.
+        Returns:
+            _type_: pd.DataFrame
+        """
+
+
+class PandasBackend(QueryBackend):
+    """
+    The PandasBackend class resolves selections in memory, with the rows of every country sorted by year.
+    """
+    name = "pandas"
+
+    def __init__(self, data: pd.DataFrame) -> None:
+        super().__init__(data)
+        self._country_rows = self._build_country_rows()
+
+    def _build_country_rows(self) -> dict:
+        rows = {}
+        years = self.data["year"].to_numpy()
+        for country, positions in self.data.groupby("country", observed=True).indices.items():
+            positions = positions[np.argsort(years[positions], kind="stable")]
+            rows[country] = (positions, years[positions])
+        return rows
+
+    def select_rows(self, year_range: tuple[int, int], countries: list[str]) -> np.ndarray:
+        """
+        Finds the rows for a (inclusive) range of years and a selection of countries, in the order of the data.
+        Returns:
+            _type_: np.ndarray
+        """
+        first, last = int(year_range[0]), int(year_range[-1])
+        selected = []
+        for country in countries:
+            if country not in self._country_rows:
+                continue
+            positions, years = self._country_rows[country]
+            start, stop = np.searchsorted(years, first, side="left"), np.searchsorted(years, last, side="right")
+            selected.append(positions[start:stop])
+        if not selected:
+            return np.array([], dtype="int64")
+        return np.sort(np.concatenate(selected))
+
+    def select(self, year_range: tuple[int, int], countries: list[str], columns: list[str]) -> pd.DataFrame:
+        return self.data.iloc[self.select_rows(year_range, countries)][["year", "country", *columns]]
+
+
+class EmbeddedBackend(QueryBackend):
+    """
+    The EmbeddedBackend class is the base of the database engines. The data is written once into a database file
+    with a row number column, every thread of a worker opens its own read-only connection.
+    """
+    file_name = "data.db"
+
+    def __init__(self, data: pd.DataFrame, path: Path) -> None:
+        super().__init__(data)
+        self.path = Path(path)
+        self.local = threading.local()
+
+    @classmethod
+    @abstractmethod
+    def write(cls, data: pd.DataFrame, directory: Path) -> None:
+        """
+        Creates the database file in a directory, with the data and an index on country and year.
+        """
+
+    @abstractmethod
+    def connect(self):
+        """
+        Opens a read-only connection to the database file.
+        Returns:
+            _type_: Connection of the engine.
+        """
+
+    def execute(self, sql: str, parameters: list) -> list[tuple]:
+        """
+        Runs a query on the connection of the current thread.
+        Returns:
+            list[tuple]: Result rows.
+        """
+        if not hasattr(self.local, "connection"):
+            self.local.connection = self.connect()
+        return self.local.connection.execute(sql, parameters).fetchall()
+
+    def select(self, year_range: tuple[int, int], countries: list[str], columns: list[str]) -> pd.DataFrame:
+        names = ["year", "country", *columns]
+        unknown = [column for column in names if column not in self.data.columns]
+        if unknown:
+            raise KeyError(f"Unknown columns {unknown}")
+        if not countries:
+            return self.data.iloc[[]][names]
+
+        # Column names come from the data (checked above), the filter values are passed as parameters.
+        projection = ", ".join(_quote(column) for column in ["_row", *names])
+        placeholders = ", ".join("?" for _ in countries)
+        sql = f"SELECT {projection} FROM data WHERE country IN ({placeholders}) AND year BETWEEN ? AND ? ORDER BY _row"
+        rows = self.execute(sql, [str(country) for country in countries] + [int(year_range[0]), int(year_range[-1])])
+
+        # The result is built column by column, directly in the data types of the data.
+        values = list(zip(*rows)) if rows else [()] * (len(names) + 1)
+        columns = {}
+        for name, column in zip(names, values[1:]):
+            dtype = self.data.dtypes[name]
+            columns[name] = pd.Categorical(column, dtype=dtype) if isinstance(dtype, pd.CategoricalDtype) else np.array(column, dtype=dtype)
+        return pd.DataFrame(columns, index=pd.Index(np.array(values[0], dtype="int64")))
+
+    @staticmethod
+    def _definitions(data: pd.DataFrame) -> str:
+        # SQL types of the columns: year as integer, country as text and all measures as real.
+        columns = [("year", "INTEGER"), ("country", "TEXT")] + [(column, "REAL") for column in data.columns[2:]]
+        return ", ".join(f"{_quote(name)} {kind}" for name, kind in columns)
+
+
+class SQLiteBackend(EmbeddedBackend):
+    """
+    The SQLiteBackend class runs the selections in SQLite (standard library).
+    """
+    name = "sqlite"
+    file_name = "data.sqlite"
+
+    @classmethod
+    def write(cls, data: pd.DataFrame, directory: Path) -> None:
+        connection = sqlite3.connect(directory / cls.file_name)
+        try:
+            connection.execute(f"CREATE TABLE data (_row INTEGER PRIMARY KEY, {cls._definitions(data)})")
+            values = [data[column].to_numpy() for column in data.columns]
+            values[1] = data["country"].astype(str).to_numpy()
+            placeholders = ", ".join("?" for _ in range(len(values) + 1))
+            connection.executemany(f"INSERT INTO data VALUES ({placeholders})", zip(range(len(data)), *(column.tolist() for column in values)))
+            connection.execute("CREATE INDEX data_country_year ON data (country, year)")
+            connection.commit()
+        finally:
+            connection.close()
+
+    def connect(self):
+        # Read-only and without locking, the file is never changed once it is published.
+        return sqlite3.connect(f"file:{self.path}?mode=ro&immutable=1", uri=True, check_same_thread=False)
+
+
+class DuckDBBackend(EmbeddedBackend):
+    """
+    The DuckDBBackend class runs the selections in DuckDB, a columnar engine (optional dependency duckdb).
+    """
+    name = "duckdb"
+    file_name = "data.duckdb"
+
+    @classmethod
+    def write(cls, data: pd.DataFrame, directory: Path) -> None:
+        import duckdb
+        connection = duckdb.connect(str(directory / cls.file_name))
+        try:
+            # The frame is scanned by DuckDB directly, the country column is stored as text.
+            frame = data.assign(country=data["country"].astype(str))
+            frame.insert(0, "_row", np.arange(len(frame), dtype="int64"))
+            connection.register("frame", frame)
+            connection.execute(f"CREATE TABLE data (_row BIGINT, {cls._definitions(data)})")
+            connection.execute("INSERT INTO data SELECT * FROM frame ORDER BY _row")
+            connection.execute("CREATE INDEX data_country_year ON data (country, year)")
+        finally:
+            connection.close()
+
+    def connect(self):
+        # Connections to the same file share one database instance within the process.
+        import duckdb
+        return duckdb.connect(str(self.path), read_only=True)
+
+
+backends = {"pandas": PandasBackend, "sqlite": SQLiteBackend, "duckdb": DuckDBBackend}
+
+
+def create_backend(name: str, data: pd.DataFrame, file_path: Path, version: Optional[str] = None) -> QueryBackend:
+    """
+    Creates the query backend for the data of a csv. Databases are cached next to the csv, built by the first worker.
+    The version is the content hash of the csv the data was read from, so that the database matches the data
+    even if the csv changed since (default: the csv as it is now).
+    If the database cannot be written (e.g. a read-only deployment), the pandas backend is used instead.
+    Returns:
+        QueryBackend: The backend.
+    """
+    if name not in backends:
+        raise ValueError(f"Unknown query backend {name!r}, use {', '.join(backends)}.")
+    backend_class = backends[name]
+    if backend_class is PandasBackend:
+        return PandasBackend(data)
+    if backend_class is DuckDBBackend:
+        # Fails early with a clear error if the optional dependency is missing.
+        import duckdb  # noqa: F401
+
+    file_path = Path(file_path)
+    cache = FileCache(file_path, file_path.parent / ".cache" / f"{file_path.stem}.{name}")
+    directory = cache.current() if version is None else cache.published(version)
+    if directory is None:
+        with cache.lock():
+            directory = cache.current() if version is None else cache.published(version)
+            if directory is None:
+                # A given version is looked up directly, it does not have to be marked as current.
+                directory = cache.publish(lambda directory: backend_class.write(data, directory), None if version is None else (None, version))
+    if directory is None:
+        logger.warning(f"The {name} database could not be written, using the pandas backend.")
+        return PandasBackend(data)
+    return backend_class(data, directory / backend_class.file_name)
+
+
+def available_backends() -> list[str]:
+    """
+    Names of the backends that can be used in this environment.
+    Returns:
+        list[str]: Backend names.
+    """
+    names = ["pandas", "sqlite"]
+    try:
+        import duckdb  # noqa: F401
+        names.append("duckdb")
+    except ImportError:
+        pass
+    return names
+
+
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
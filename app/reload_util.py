@@ -0,0 +1,125 @@
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import Iterable, Optional
+from shiny import reactive
+from cache_util import caches
+from data_util import CountryModel, DataModel, get_data_model, loaded_models, set_models
+from metrics_util import metrics, timed
+from worker_util import reset_executor
+import map_util
+import config
+
+#----------------------------------------------------------------
+# Hot reload of the data files. A background thread watches the csv, the centroids and the geojson.
+# When one of them has changed (and stopped changing), the new models and caches are built off the request path,
+# swapped in at once, and every open session re-renders its outputs with the new data. Workers keep running.
+#----------------------------------------------------------------
+
+logger = logging.getLogger("dashboard.reload")
+
+# Source files by the part of the data they are used for.
+sources = {"data": DataModel.file_path, "centroids": CountryModel.file_path, "geometry": CountryModel.geo_path}
+
+# Version of the data in this process, increased with every reload.
+state = {"version": 0}
+reload_lock = threading.Lock()
+
+
+def fingerprints() -> dict:
+    """
+    Size and modification time of every source file, None for files that are missing (e.g. while being replaced).
+    Returns:
+        dict: Fingerprint per source.
+    """
+    result = {}
+    for name, path in sources.items():
+        try:
+            stat = Path(path).stat()
+            result[name] = (stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            result[name] = None
+    return result
+
+
+def reload_data(changed: Optional[Iterable[str]] = None) -> None:
+    """
+    Builds the models and geometry for the changed sources (default: all), then swaps them in and clears
+    everything derived from the previous data. Readers get either the old or the new models, never a mix of one model.
+    """
+    changed = set(sources if changed is None else changed)
+    with reload_lock, timed("data_reload"):
+        # The heavy parts are built before the swap, while the sessions keep using the previous data.
+        data_model = DataModel() if "data" in changed else get_data_model()
+        country_model = CountryModel(data_model) if "country" in loaded_models() else None
+        if "geometry" in changed:
+            # Parses the geojson and publishes the topology cache, which is memory-mapped after the swap.
+            map_util.load_topology.__wrapped__()
+
+        # One critical section: the swap itself invalidates every cached value of the previous models (see
+        # cache_util.data_generation), the clears only free their memory, and the version lets the sessions render again.
+        set_models(data=data_model, country=country_model)
+        levels = map_util.clear_caches()
+        for cache in caches.values():
+            cache.clear()
+        reset_executor()
+        state["version"] += 1
+
+        # Rebuilding what the sessions of this process used before, so the next render does not pay for it.
+        if levels:
+            map_util.load_data_keys()
+        for level in levels:
+            map_util.load_geo_level(level)
+
+    metrics.inc("data_reloads")
+    logger.info(f"Reloaded data ({', '.join(sorted(changed))}), now at version {state['version']}.")
+
+
+def start_reload_watcher(interval: float) -> None:
+    """
+    Checks the source files every interval (in seconds) and reloads the data once a change has settled,
+    i.e. the files did not change any further between two checks (so half copied files are never loaded).
+    """
+    def run() -> None:
+        known = fingerprints()
+        pending = None
+        while True:
+            time.sleep(interval)
+            current = fingerprints()
+            if current == known or None in current.values():
+                pending = None
+                continue
+            if current != pending:
+                pending = current
+                continue
+            changed = [name for name in sources if current[name] != known[name]]
+            # The new fingerprints are kept even if the reload fails, a broken file is only retried once it changes again.
+            known, pending = current, None
+            try:
+                reload_data(changed)
+            except Exception:
+                metrics.inc("data_reload_errors")
+                logger.exception(f"Reloading the data ({', '.join(changed)}) failed, the previous data is kept.")
+
+    threading.Thread(target=run, name="data-reload", daemon=True).start()
+
+
+def current_version() -> int:
+    """
+    Version of the data in this process.
+    Returns:
+        int: Number of reloads so far.
+    """
+    return state["version"]
+
+
+# Reactive version of the data, shared by all sessions of the process. Outputs that read it are rendered
+# again after a reload. Without reloads it never changes and nothing is polled.
+if config.RELOAD_INTERVAL > 0:
+    @reactive.poll(current_version, min(1.0, config.RELOAD_INTERVAL))
+    def data_version() -> int:
+        return current_version()
+else:
+    def data_version() -> int:
+        return 0
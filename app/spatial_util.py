@@ -0,0 +1,121 @@
+import math
+from typing import Iterator, Optional
+
+#----------------------------------------------------------------
+# Spatial index over the country polygons, to find the country at a coordinate (e.g. a click on the map).
+# The bounding boxes of all polygons are packed into an R-tree (sort-tile-recursive), so a lookup only visits
+# the few boxes around the point before the exact point-in-polygon test.
+#----------------------------------------------------------------
+
+class RTree():
+    """
+    The RTree class is a static R-tree over bounding boxes (min_x, min_y, max_x, max_y), built once with STR packing.
+    """
+
+    def __init__(self, entries: list[tuple[tuple, object]], capacity: int = 8) -> None:
+        self.capacity = capacity
+        # Every node is (bounding box, children, leaf). Leaf children are the items, other children are nodes.
+        nodes = [(box, item, True) for box, item in entries]
+        while len(nodes) > capacity:
+            nodes = [(_union(box for box, _, _ in group), group, False) for group in self._pack(nodes)]
+        self.root = (_union(box for box, _, _ in nodes), nodes, False) if nodes else None
+
+    def _pack(self, nodes: list) -> list[list]:
+        # Sort-tile-recursive: vertical slices by x, then groups of capacity by y within each slice.
+        n_groups = math.ceil(len(nodes) / self.capacity)
+        slice_size = math.ceil(math.sqrt(n_groups)) * self.capacity
+        nodes = sorted(nodes, key=lambda node: node[0][0] + node[0][2])
+        groups = []
+        for start in range(0, len(nodes), slice_size):
+            column = sorted(nodes[start:start + slice_size], key=lambda node: node[0][1] + node[0][3])
+            groups.extend(column[i:i + self.capacity] for i in range(0, len(column), self.capacity))
+        return groups
+
+    def query(self, x: float, y: float) -> Iterator[object]:
+        """
+        Items whose bounding box contains the point.
+        Returns:
+            Iterator[object]: Matching items.
+        """
+        if self.root is None:
+            return
+        stack = [self.root]
+        while stack:
+            box, children, leaf = stack.pop()
+            if not (box[0] <= x <= box[2] and box[1] <= y <= box[3]):
+                continue
+            if leaf:
+                yield children
+            else:
+                stack.extend(children)
+
+
+class SpatialIndex():
+    """
+    The SpatialIndex class finds the feature of a geojson FeatureCollection at a coordinate.
+    """
+
+    def __init__(self, geojson: dict) -> None:
+        entries = []
+        self.bounds = {}
+        for feature in geojson["features"]:
+            for polygon in _polygons(feature["geometry"]):
+                box = _bounds(polygon[0])
+                entries.append((box, (feature["id"], polygon)))
+                # The largest polygon of a feature (by its bounding box) is its main land mass.
+                if feature["id"] not in self.bounds or _area(box) > _area(self.bounds[feature["id"]]):
+                    self.bounds[feature["id"]] = box
+        self.tree = RTree(entries)
+
+    def locate(self, lat: float, lon: float) -> Optional[str]:
+        """
+        Finds the feature containing the point. Longitudes outside of -180 to 180 (after panning around the globe) are wrapped.
+        Returns:
+            Optional[str]: Feature id, None if the point is not within any feature.
+        """
+        lon = (lon + 180) % 360 - 180
+        for feature_id, polygon in self.tree.query(lon, lat):
+            if _contains(polygon, lon, lat):
+                return feature_id
+        return None
+
+    def get_center(self, feature_id: str) -> tuple[float, float]:
+        """
+        Center of the bounding box of the largest polygon of a feature, as (latitude, longitude).
+        Returns:
+            tuple[float, float]: Position of the center.
+        """
+        min_x, min_y, max_x, max_y = self.bounds[feature_id]
+        return ((min_y + max_y) / 2, (min_x + max_x) / 2)
+
+
+def _polygons(geometry: dict) -> list:
+    if geometry["type"] == "Polygon":
+        return [geometry["coordinates"]]
+    return geometry["coordinates"]
+
+
+def _bounds(ring: list) -> tuple[float, float, float, float]:
+    xs = [point[0] for point in ring]
+    ys = [point[1] for point in ring]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+def _union(boxes) -> tuple[float, float, float, float]:
+    boxes = list(boxes)
+    return (min(box[0] for box in boxes), min(box[1] for box in boxes), max(box[2] for box in boxes), max(box[3] for box in boxes))
+
+
+def _area(box: tuple) -> float:
+    return (box[2] - box[0]) * (box[3] - box[1])
+
+
+def _contains(polygon: list, x: float, y: float) -> bool:
+    # Even-odd rule over all rings, so that points in holes are outside.
+    inside = False
+    for ring in polygon:
+        for p, q in zip(ring, ring[1:] + ring[:1]):
+            (x1, y1), (x2, y2) = p[:2], q[:2]
+            if (y1 > y) != (y2 > y) and x < (x2 - x1) * (y - y1) / (y2 - y1) + x1:
+                inside = not inside
+    return inside
@@ -0,0 +1,249 @@
+import hashlib
+import json
+import os
+import shutil
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Iterator, Optional
+import numpy as np
+import pandas as pd
+
+try:
+    import fcntl
+except ImportError:
+    # Without file locks (Windows), several workers may build the same cache at once, which is still safe.
+    fcntl = None
+
+#----------------------------------------------------------------
+# Binary columnar cache for prepared DataFrames.
+# Every column is stored as its own .npy file, so a cold start only has to read raw arrays
+# instead of parsing the CSV text again. The cache is tied to the source file and rebuilt
+# automatically as soon as the source changes.
+# Arrays can be memory-mapped read-only, so that all worker processes on a machine share one copy
+# of the data in the page cache instead of holding their own.
+#----------------------------------------------------------------
+
+class FileCache():
+    """
+    The FileCache class manages a versioned cache directory for files derived from a source file.
+    A version is published atomically and replaced as soon as the content of the source changes.
+    """
+
+    def __init__(self, source: Path, cache_dir: Path) -> None:
+        self.source = Path(source)
+        self.cache_dir = Path(cache_dir)
+        self.pointer = self.cache_dir / "current.json"
+
+    def fingerprint(self) -> dict:
+        """
+        Cheap fingerprint of the source file, used to detect changes without reading it.
+        Returns:
+            _type_: dict
+        """
+        stat = self.source.stat()
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    def source_hash(self) -> str:
+        """
+        Content hash of the source file. Only computed when the fingerprint does not match.
+        Returns:
+            _type_: str
+        """
+        digest = hashlib.sha256()
+        with open(self.source, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def version(self) -> tuple[dict, str]:
+        """
+        Fingerprint and content hash of the source file as it is now. Taken before the source is read,
+        so that what was read from it is published under the version it came from (see publish).
+        Returns:
+            tuple[dict, str]: Fingerprint and hash.
+        """
+        fingerprint = self.fingerprint()
+        return fingerprint, self.source_hash()
+
+    def published(self, digest: str) -> Optional[Path]:
+        """
+        Directory of a published version of the cache, whether or not it is the current one.
+        Returns:
+            Optional[Path]: The directory, or None if the version was never published (or is removed).
+        """
+        directory = self.cache_dir / digest
+        return directory if directory.is_dir() else None
+
+    def current(self) -> Optional[Path]:
+        """
+        Directory of the published cache for the current version of the source file.
+        Returns:
+            Optional[Path]: The directory, or None if there is no valid cache.
+        """
+        try:
+            fingerprint = self.fingerprint()
+            pointer = json.loads(self.pointer.read_text()) if self.pointer.exists() else {}
+
+            # Fast path: the source file was not touched since the cache was written.
+            if pointer.get("fingerprint") == fingerprint and (self.cache_dir / pointer["hash"]).is_dir():
+                return self.cache_dir / pointer["hash"]
+
+            # The file was touched, but its content may still be the same (e.g. after a fresh checkout).
+            digest = self.source_hash()
+            if (self.cache_dir / digest).is_dir():
+                self._write_pointer(fingerprint, digest)
+                return self.cache_dir / digest
+        except (OSError, ValueError, KeyError):
+            # A missing or damaged cache is never fatal, the caller falls back to the source.
+            pass
+        return None
+
+    def publish(self, write: Callable[[Path], None], version: Optional[tuple[Optional[dict], str]] = None) -> Optional[Path]:
+        """
+        Writes a version of the cache with the given function and marks it as current for the source file.
+        The version (see version) defaults to the source as it is now. It is only marked as current if the source
+        still has its fingerprint, otherwise the next reader publishes the newer version. A version without
+        fingerprint is published without being marked as current.
+        Returns:
+            Optional[Path]: Directory of the published cache, None if it could not be written.
+        """
+        try:
+            fingerprint, digest = version or self.version()
+            target = self.cache_dir / digest
+
+            if not target.exists():
+                # Write into a temporary directory first, so that other workers never see half a cache.
+                tmp = self.cache_dir / f".tmp-{digest}-{os.getpid()}"
+                shutil.rmtree(tmp, ignore_errors=True)
+                tmp.mkdir(parents=True)
+                write(tmp)
+                try:
+                    os.rename(tmp, target)
+                except OSError:
+                    # Another worker was faster, its cache is identical.
+                    shutil.rmtree(tmp, ignore_errors=True)
+
+            if self.fingerprint() == fingerprint:
+                self._write_pointer(fingerprint, digest)
+            self._remove_stale(digest)
+            return target
+        except OSError:
+            # Read-only deployments simply run without the cache.
+            return None
+
+    @contextmanager
+    def lock(self) -> Iterator[None]:
+        """
+        Exclusive lock across processes, so that only one worker builds and publishes the cache while the others wait.
+        """
+        handle = None
+        try:
+            if fcntl is not None:
+                self.cache_dir.mkdir(parents=True, exist_ok=True)
+                handle = open(self.cache_dir / ".lock", "w")
+                fcntl.flock(handle, fcntl.LOCK_EX)
+        except OSError:
+            handle = None
+        try:
+            yield
+        finally:
+            if handle is not None:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+                handle.close()
+
+    def _write_pointer(self, fingerprint: dict, digest: str) -> None:
+        tmp = self.cache_dir / f".current-{os.getpid()}.json"
+        tmp.write_text(json.dumps({"fingerprint": fingerprint, "hash": digest}))
+        os.replace(tmp, self.pointer)
+
+    def _remove_stale(self, digest: str) -> None:
+        # The cache for the current version of the source file is kept, and the most recent previous one,
+        # which other workers may still use until they have reloaded the data.
+        try:
+            stale = [path for path in self.cache_dir.iterdir() if path.is_dir() and not path.name.startswith(".") and path.name != digest]
+            stale.sort(key=lambda path: path.stat().st_mtime_ns, reverse=True)
+        except OSError:
+            # Another worker is cleaning up at the same time.
+            return
+        for path in stale[1:]:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+class ColumnStore(FileCache):
+    """
+    The ColumnStore class saves and loads a DataFrame (and arrays derived from it) as a directory of NumPy arrays.
+    Every method takes the directory of one version (see current and save), so that the DataFrame and the arrays
+    derived from it always come from the same version, even if the source is published again in between.
+    """
+
+    def load(self, directory: Optional[Path], mmap: bool = False) -> Optional[pd.DataFrame]:
+        """
+        Loads the DataFrame cached in the directory of a version.
+        With mmap, the columns are read-only views of the cache files, shared by all processes.
+        Returns:
+            Optional[pd.DataFrame]: The cached data, or None if there is no valid cache.
+        """
+        if directory is None:
+            return None
+        try:
+            return self._read(directory, mmap)
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def load_array(self, directory: Optional[Path], name: str, mmap: bool = False) -> Optional[np.ndarray]:
+        """
+        Loads an array that was saved together with the DataFrame of the directory by save_array.
+        Returns:
+            Optional[np.ndarray]: The array, or None if the cache does not contain it.
+        """
+        try:
+            return None if directory is None else np.load(directory / f"{name}.array.npy", mmap_mode="r" if mmap else None, allow_pickle=False)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, df: pd.DataFrame, version: Optional[tuple[Optional[dict], str]] = None) -> Optional[Path]:
+        """
+        Writes the DataFrame, read from the given version of the source, into the cache (see publish).
+        Returns:
+            Optional[Path]: Directory of the version, None if it could not be written.
+        """
+        return self.publish(lambda directory: self._write(df, directory), version)
+
+    def save_array(self, directory: Path, name: str, array: np.ndarray) -> None:
+        """
+        Adds an array derived from the DataFrame of the directory (e.g. an index) to that version of the cache.
+        """
+        try:
+            # Written under a temporary name first, so that other workers never load half an array.
+            tmp = directory / f".{name}-{os.getpid()}.npy"
+            np.save(tmp, np.ascontiguousarray(array), allow_pickle=False)
+            os.replace(tmp, directory / f"{name}.array.npy")
+        except OSError:
+            pass
+
+    def _write(self, df: pd.DataFrame, directory: Path) -> None:
+        meta = {"columns": [], "categories": {}}
+        for i, column in enumerate(df.columns):
+            values = df[column]
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                # Categorical columns are stored as integer codes plus their list of categories.
+                meta["categories"][str(i)] = [str(c) for c in values.cat.categories]
+                array = values.cat.codes.to_numpy()
+            else:
+                array = values.to_numpy()
+            np.save(directory / f"{i}.npy", array, allow_pickle=False)
+            meta["columns"].append(column)
+        (directory / "meta.json").write_text(json.dumps(meta))
+
+    def _read(self, directory: Path, mmap: bool = False) -> pd.DataFrame:
+        meta = json.loads((directory / "meta.json").read_text())
+        columns = {}
+        for i, column in enumerate(meta["columns"]):
+            array = np.load(directory / f"{i}.npy", mmap_mode="r" if mmap else None, allow_pickle=False)
+            categories = meta["categories"].get(str(i))
+            if categories is not None:
+                columns[column] = pd.Categorical.from_codes(array, categories=categories)
+            else:
+                columns[column] = array
+        # Without copy, every column keeps pointing to its (memory-mapped) array.
+        return pd.DataFrame(columns, copy=False)
@@ -0,0 +1,148 @@
+import math
+from typing import NamedTuple
+import pandas as pd
+from cache_util import ResultCache
+from data_util import DataModel, get_data_model
+from metrics_util import timed
+import config
+
+#----------------------------------------------------------------
+# Contains helper functions for the server side handling of the data table.
+# The browser only ever receives the rows of the current page, sorting and searching happen here.
+#----------------------------------------------------------------
+
+def search_rows(df: pd.DataFrame, text: str) -> pd.DataFrame:
+    """
+    Keeps the rows where any column contains the text (case insensitive).
+    Returns:
+        pd.DataFrame: Matching rows.
+    """
+    text = text.strip().lower()
+    if not text:
+        return df
+
+    mask = pd.Series(False, index=df.index)
+    for column in df.columns:
+        values = df[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            # Only the categories are searched, the rows are then matched by their codes.
+            matches = [category for category in values.cat.categories if text in str(category).lower()]
+            mask |= values.isin(matches)
+        else:
+            # Values are searched as shown in the table (rounded), missing values (derived metrics) never match.
+            if pd.api.types.is_float_dtype(values):
+                values = values.astype("float64").round(DataModel.decimals)
+            mask |= values.notna() & values.astype(str).str.lower().str.contains(text, regex=False)
+    return df[mask]
+
+
+def sort_rows(df: pd.DataFrame, column: str, descending: bool = False) -> pd.DataFrame:
+    """
+    Sorts the rows by one column. Unknown columns leave the order unchanged.
+    Returns:
+        pd.DataFrame: Sorted rows.
+    """
+    if column not in df.columns:
+        return df
+    # Categorical columns (country) are sorted by their codes, the categories are in alphabetical order.
+    return df.sort_values(column, ascending=not descending, kind="stable")
+
+
+def page_count(n_rows: int, page_size: int) -> int:
+    """
+    Number of pages needed for the rows, at least one.
+    Returns:
+        int: Number of pages.
+    """
+    return max(1, math.ceil(n_rows / page_size))
+
+
+def page_rows(df: pd.DataFrame, page: int, page_size: int) -> pd.DataFrame:
+    """
+    Returns the rows of one page (starting at 1). Pages outside the range are clamped.
+    Returns:
+        pd.DataFrame: Rows of the page.
+    """
+    page = min(max(1, int(page)), page_count(len(df), page_size))
+    start = (page - 1) * page_size
+    return df.iloc[start:start + page_size]
+
+
+def pretty_columns(columns) -> list[str]:
+    """
+    Prettier column names for presenting the data.
+    Returns:
+        list[str]: Column names with spaces and title case.
+    """
+    return list(pd.Index(columns).str.replace('_', ' ').str.title())
+
+
+#----------------------------------------------------------------
+# Building one page of the table from the filters. This is the heavy part of the table render,
+# it only depends on its arguments, so that it can also run in a worker pool.
+#----------------------------------------------------------------
+
+# Process-wide caches of table selections and of their searched and sorted views, shared by all sessions.
+table_cache = ResultCache("table", config.CACHE_MAX_BYTES)
+view_cache = ResultCache("table_view", config.CACHE_MAX_BYTES)
+
+
+class TablePage(NamedTuple):
+    """
+    One page of the table, ready to be sent to the browser, and its position within all matching rows.
+    """
+    rows: pd.DataFrame
+    n_rows: int
+    page: int
+    page_size: int
+
+
+def select_view(years: tuple[int, int], countries: list[str], columns: list[str], search: str, sort: str, descending: bool) -> pd.DataFrame:
+    """
+    Selects, searches and sorts the rows. Selections are keyed on the normalized filters (sorted countries and columns).
+    Returns:
+        pd.DataFrame: Matching rows, in the requested order.
+    """
+    dm = get_data_model()
+    years = tuple(int(year) for year in years)
+    key = (years, tuple(sorted(countries)), tuple(sorted(columns)))
+
+    def select() -> pd.DataFrame:
+        with timed("table_select"):
+            return dm.select(years, list(key[1]), list(key[2]))
+
+    def view() -> pd.DataFrame:
+        with timed("table_view"):
+            df = search_rows(table_cache.get_or_compute(key, select), search)
+            return sort_rows(df, sort, descending)
+
+    return view_cache.get_or_compute((key, search.strip().lower(), sort, descending), view)
+
+
+def build_page(years: tuple[int, int], countries: list[str], columns: list[str], search: str, sort: str, descending: bool, page: int, page_size: int) -> TablePage:
+    """
+    Builds one page of the table, with the columns in the selected order and pretty column names.
+    Returns:
+        TablePage: Rows of the page and its position.
+    """
+    df = select_view(years, countries, columns, search, sort, descending)
+    n_rows = len(df)
+    page = min(max(1, int(page or 1)), page_count(n_rows, page_size))
+    rows = present_rows(page_rows(df, page, page_size), columns)
+    return TablePage(rows, n_rows, page, page_size)
+
+
+def present_rows(df: pd.DataFrame, columns: list[str]) -> pd.DataFrame:
+    """
+    Prepares rows for presenting (or exporting) them: the columns in the selected order, rounded values and pretty column names.
+    Returns:
+        pd.DataFrame: Rows as shown in the table.
+    """
+    rows = df[["year", "country", *columns]]
+
+    # Measures are stored as float32, which would show rounding noise in the browser.
+    rows = rows.astype({column: "float64" for column in columns}).round(DataModel.decimals)
+
+    # Prettier columns for presenting the data.
+    rows.columns = pretty_columns(rows.columns)
+    return rows
@@ -0,0 +1,244 @@
+import json
+import math
+from pathlib import Path
+from typing import Sequence
+import numpy as np
+
+#----------------------------------------------------------------
+# Helper for reducing the size of the country polygons sent to the browser.
+# The geojson is converted into a topology (similar to TopoJSON): coordinates are quantized to an
+# integer grid and every border is stored once as an arc, shared by the countries on both sides.
+# Arcs are simplified on their own, so neighbouring countries still fit together after simplification.
+# A topology can be saved as flat integer arrays and memory-mapped, so that worker processes share its arcs.
+#----------------------------------------------------------------
+
+class Topology():
+    """
+    The Topology class stores quantized, shared arcs for the polygons of a geojson FeatureCollection.
+    """
+
+    def __init__(self, geojson: dict, quantization: int = 100000) -> None:
+        # Grid used for the quantization, spanning the bounding box of all coordinates.
+        points = [point for feature in geojson["features"] for ring in _rings(feature["geometry"]) for point in ring]
+        self.x0 = min(point[0] for point in points)
+        self.y0 = min(point[1] for point in points)
+        self.kx = (max(point[0] for point in points) - self.x0) / (quantization - 1) or 1
+        self.ky = (max(point[1] for point in points) - self.y0) / (quantization - 1) or 1
+
+        # Number of decimals needed to write a coordinate without losing the quantized precision.
+        self.decimals = max(0, math.ceil(-math.log10(min(self.kx, self.ky))))
+
+        self.arcs = []
+        self.features = []
+        self._arc_index = {}
+
+        quantized = [[[self._quantize(ring) for ring in polygon] for polygon in _polygons(feature["geometry"])]
+                     for feature in geojson["features"]]
+        junctions = _junctions(ring for polygons in quantized for polygon in polygons for ring in polygon)
+
+        for feature, polygons in zip(geojson["features"], quantized):
+            self.features.append({
+                "type": "Feature",
+                "id": feature.get("id"),
+                "properties": feature.get("properties", {}),
+                "polygons": [[self._cut(ring, junctions) for ring in polygon] for polygon in polygons],
+            })
+
+    def save(self, directory: Path) -> None:
+        """
+        Writes the topology into a directory: all arc points as one integer array, the arc offsets and the features as JSON.
+        """
+        directory = Path(directory)
+        offsets = np.cumsum([0] + [len(arc) for arc in self.arcs], dtype=np.int64)
+        points = np.array([point for arc in self.arcs for point in arc], dtype=np.int32).reshape(-1, 2)
+        np.save(directory / "points.npy", points, allow_pickle=False)
+        np.save(directory / "offsets.npy", offsets, allow_pickle=False)
+        meta = {"x0": self.x0, "y0": self.y0, "kx": self.kx, "ky": self.ky, "decimals": self.decimals, "features": self.features}
+        (directory / "topology.json").write_text(json.dumps(meta))
+
+    @classmethod
+    def load(cls, directory: Path, mmap: bool = False) -> "Topology":
+        """
+        Reads a topology written by save. With mmap, the arcs are read-only views of the files, shared by all processes.
+        Returns:
+            Topology: The loaded topology.
+        """
+        directory = Path(directory)
+        meta = json.loads((directory / "topology.json").read_text())
+        topology = cls.__new__(cls)
+        topology.x0, topology.y0, topology.kx, topology.ky = meta["x0"], meta["y0"], meta["kx"], meta["ky"]
+        topology.decimals = meta["decimals"]
+        topology.features = meta["features"]
+        mmap_mode = "r" if mmap else None
+        topology.arcs = ArcList(np.load(directory / "points.npy", mmap_mode=mmap_mode, allow_pickle=False),
+                                np.load(directory / "offsets.npy", mmap_mode=mmap_mode, allow_pickle=False))
+        # The index is only needed while the arcs are built.
+        topology._arc_index = {}
+        return topology
+
+    def _quantize(self, ring: list) -> list[tuple[int, int]]:
+        quantized = []
+        for x, y in (point[:2] for point in ring):
+            point = (round((x - self.x0) / self.kx), round((y - self.y0) / self.ky))
+            # Points that fall onto the same grid cell are merged.
+            if not quantized or quantized[-1] != point:
+                quantized.append(point)
+        if quantized[0] != quantized[-1]:
+            quantized.append(quantized[0])
+        return quantized
+
+    def _cut(self, ring: list[tuple[int, int]], junctions: set) -> list[int]:
+        # Rotate the ring so that it starts at a junction, then cut it into arcs at every junction.
+        # Arcs are referenced by index, a negative index (~i) means the arc is used in reverse.
+        points = ring[:-1]
+        starts = [i for i, point in enumerate(points) if point in junctions]
+        if not starts:
+            return [self._add_arc(ring)]
+
+        points = points[starts[0]:] + points[:starts[0]] + [points[starts[0]]]
+        refs = []
+        arc = [points[0]]
+        for point in points[1:]:
+            arc.append(point)
+            if point in junctions:
+                refs.append(self._add_arc(arc))
+                arc = [point]
+        return refs
+
+    def _add_arc(self, arc: list[tuple[int, int]]) -> int:
+        key = tuple(arc)
+        if key in self._arc_index:
+            return self._arc_index[key]
+        reverse = key[::-1]
+        if reverse in self._arc_index:
+            return ~self._arc_index[reverse]
+        self._arc_index[key] = len(self.arcs)
+        self.arcs.append(arc)
+        return len(self.arcs) - 1
+
+    def to_geojson(self, tolerance: float = 0.0) -> dict:
+        """
+        Rebuilds the geojson with every arc simplified by the given tolerance (in degrees).
+        Rings that become too small are dropped, but every feature keeps at least one polygon.
+        Returns:
+            dict: geojson FeatureCollection with rounded coordinates.
+        """
+        epsilon = tolerance / min(self.kx, self.ky)
+        arcs = [simplify(arc, epsilon) for arc in self.arcs]
+
+        features = []
+        for feature in self.features:
+            polygons = []
+            for polygon in feature["polygons"]:
+                rings = [self._ring(refs, arcs) for refs in polygon]
+                if len(rings[0]) < 4:
+                    continue
+                polygons.append([ring for ring in rings if len(ring) >= 4])
+            if not polygons:
+                # Tiny countries would disappear completely, so they keep their unsimplified outline.
+                polygons = [[self._ring(feature["polygons"][0][0], self.arcs)]]
+
+            if len(polygons) == 1:
+                geometry = {"type": "Polygon", "coordinates": polygons[0]}
+            else:
+                geometry = {"type": "MultiPolygon", "coordinates": polygons}
+            features.append({"type": "Feature", "id": feature["id"], "properties": feature["properties"], "geometry": geometry})
+
+        return {"type": "FeatureCollection", "features": features}
+
+    def _ring(self, refs: list[int], arcs: list) -> list[list[float]]:
+        points = []
+        for ref in refs:
+            arc = arcs[ref] if ref >= 0 else arcs[~ref][::-1]
+            # Consecutive arcs share their end and start point.
+            points.extend(arc if not points else arc[1:])
+        return [[round(self.x0 + x * self.kx, self.decimals), round(self.y0 + y * self.ky, self.decimals)] for x, y in points]
+
+
+class ArcList(Sequence):
+    """
+    The ArcList class gives access to arcs stored as one array of points and the offsets of every arc.
+    An arc is only converted into a list of points when it is accessed.
+    """
+
+    def __init__(self, points: np.ndarray, offsets: np.ndarray) -> None:
+        self.points = points
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> list[tuple[int, int]]:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return list(map(tuple, self.points[self.offsets[index]:self.offsets[index + 1]].tolist()))
+
+
+def simplify(arc: list[tuple[int, int]], epsilon: float) -> list[tuple[int, int]]:
+    """
+    Douglas-Peucker simplification of a single arc. The end points are always kept.
+    Returns:
+        list[tuple[int, int]]: Simplified arc.
+    """
+    if epsilon <= 0 or len(arc) < 3:
+        return arc
+
+    keep = [False] * len(arc)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(arc) - 1)]
+
+    # A closed arc has the same start and end, so it is split at the point farthest from the start.
+    if arc[0] == arc[-1]:
+        farthest = max(range(1, len(arc) - 1), key=lambda i: _distance(arc[i], arc[0], arc[0]))
+        keep[farthest] = True
+        stack = [(0, farthest), (farthest, len(arc) - 1)]
+
+    while stack:
+        first, last = stack.pop()
+        index, max_distance = None, epsilon
+        for i in range(first + 1, last):
+            distance = _distance(arc[i], arc[first], arc[last])
+            if distance > max_distance:
+                index, max_distance = i, distance
+        if index is not None:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+
+    return [point for point, kept in zip(arc, keep) if kept]
+
+
+def _distance(point: tuple, start: tuple, end: tuple) -> float:
+    # Distance of a point to the segment between start and end.
+    (px, py), (ax, ay), (bx, by) = point, start, end
+    dx, dy = bx - ax, by - ay
+    if dx == 0 and dy == 0:
+        return math.hypot(px - ax, py - ay)
+    t = max(0.0, min(1.0, ((px - ax) * dx + (py - ay) * dy) / (dx * dx + dy * dy)))
+    return math.hypot(px - (ax + t * dx), py - (ay + t * dy))
+
+
+def _polygons(geometry: dict) -> list:
+    if geometry["type"] == "Polygon":
+        return [geometry["coordinates"]]
+    return geometry["coordinates"]
+
+
+def _rings(geometry: dict) -> list:
+    return [ring for polygon in _polygons(geometry) for ring in polygon]
+
+
+def _junctions(rings) -> set:
+    # A point is a junction if it is reached from different neighbours, i.e. where borders meet or split.
+    neighbours = {}
+    junctions = set()
+    for ring in rings:
+        points = ring[:-1]
+        for i, point in enumerate(points):
+            pair = frozenset((points[i - 1], points[(i + 1) % len(points)]))
+            seen = neighbours.setdefault(point, pair)
+            if seen != pair:
+                junctions.add(point)
+    return junctions
@@ -0,0 +1,133 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, AsyncIterator, Callable, Iterator, Optional
+from shiny import reactive, req
+from metrics_util import metrics, timed
+import config
+
+#----------------------------------------------------------------
+# Offloading the heavy part of renders to a worker pool, so that one session cannot stall the event loop
+# (and with it the reactive updates of all other sessions in the same process).
+# Jobs are plain functions of their arguments; they must not touch widgets or reactive values,
+# and in the process pool their arguments and results are pickled.
+#----------------------------------------------------------------
+
+@lru_cache(maxsize=None)
+def get_executor() -> Optional[Executor]:
+    """
+    The worker pool of this process, as configured by RENDER_EXECUTOR.
+    Returns:
+        Optional[Executor]: Thread or process pool, None if renders run inline.
+    """
+    if config.RENDER_EXECUTOR == "thread":
+        return ThreadPoolExecutor(max_workers=config.RENDER_WORKERS, thread_name_prefix="render")
+    if config.RENDER_EXECUTOR == "process":
+        # Forking a process with a running event loop and threads is unsafe, the workers are started fresh.
+        return ProcessPoolExecutor(max_workers=config.RENDER_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    if config.RENDER_EXECUTOR != "inline":
+        raise ValueError(f"Unknown render executor {config.RENDER_EXECUTOR!r}, use inline, thread or process.")
+    return None
+
+
+def reset_executor() -> None:
+    """
+    Replaces the process pool after the data was reloaded, as its workers still hold the previous data.
+    Jobs that are already running finish in the old pool. Threads share the data of this process and are kept.
+    """
+    if config.RENDER_EXECUTOR != "process":
+        return
+    executor = get_executor()
+    get_executor.cache_clear()
+    executor.shutdown(wait=False)
+
+
+def shutdown_executor() -> None:
+    """
+    Stops the worker pool when the app shuts down. Queued jobs are cancelled and the worker processes are joined,
+    so that they (and the resource tracker of multiprocessing) do not outlive the server.
+    """
+    if get_executor.cache_info().currsize == 0:
+        return
+    executor = get_executor()
+    get_executor.cache_clear()
+    if executor is not None:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def use_workers() -> bool:
+    """
+    Whether renders are offloaded to a worker pool.
+    Returns:
+        _type_: bool
+    """
+    return get_executor() is not None
+
+
+async def run_in_worker(job: Callable[..., Any], *args) -> Any:
+    """
+    Runs a job in the worker pool, or directly if there is none.
+    Cancelling the awaiting task also cancels the job if it has not started yet.
+    Returns:
+        Any: Result of the job.
+    """
+    executor = get_executor()
+    if executor is None:
+        return job(*args)
+    return await asyncio.wrap_future(executor.submit(job, *args))
+
+
+async def iterate_in_thread(iterator: Iterator[Any]) -> AsyncIterator[Any]:
+    """
+    Runs a generator step by step in a thread (of the pool if renders use threads), so that producing
+    each item never blocks the event loop. Generators can not be sent to other processes, a process pool is not used.
+    Returns:
+        AsyncIterator[Any]: Items of the generator.
+    """
+    executor = get_executor() if config.RENDER_EXECUTOR == "thread" else None
+    loop = asyncio.get_running_loop()
+    done = object()
+    while True:
+        item = await loop.run_in_executor(executor, next, iterator, done)
+        if item is done:
+            return
+        yield item
+
+
+class RenderTask():
+    """
+    The RenderTask class runs a job for one output in the worker pool, as an extended task of the session.
+    Invoking it again while a job is running cancels that job, so only the result of the latest inputs is applied.
+    """
+
+    def __init__(self, output: str, job: Callable[..., Any]) -> None:
+        self.output = output
+        self.job = job
+        self.task = reactive.ExtendedTask(self._run)
+
+    async def _run(self, *args) -> Any:
+        with timed("worker_job", output=self.output):
+            return await run_in_worker(self.job, *args)
+
+    def invoke(self, *args) -> None:
+        """
+        Starts the job with new arguments, cancelling the job that is still running for older ones.
+        """
+        with reactive.isolate():
+            if self.task.status() == "running":
+                self.task.cancel()
+                metrics.inc("renders_cancelled", output=self.output)
+        self.task.invoke(*args)
+
+    def result(self) -> Any:
+        """
+        Result of the latest job, to be read in a render function or effect.
+        While a job is running, the output shows its progress state instead.
+        Returns:
+            Any: Result of the job.
+        """
+        # A cancelled job is always followed by a newer one, so the output keeps waiting instead of being cleared.
+        if self.task.status() == "cancelled":
+            req(False, cancel_output="progress")
+        return self.task.result()
@@ -0,0 +1,266 @@
+import argparse
+import gc
+import itertools
+import json
+import platform
+import shutil
+import statistics
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import pandas as pd
+
+#----------------------------------------------------------------
+# Benchmarks for the hot paths of the dashboard, run headless (no browser, no Shiny session).
+# Usage (from the repository root):
+#   python benchmarks/benchmark.py                      run all benchmarks and compare with the baseline
+#   python benchmarks/benchmark.py --scales 10 100 1000 also run on synthetic datasets of that many times the rows
+#   python benchmarks/benchmark.py --save-baseline      store the results as the new baseline
+#----------------------------------------------------------------
+
+APP_DIR = Path(__file__).resolve().parent.parent / "app"
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(APP_DIR))
+
+from data_util import DataModel, CountryModel, get_data_model  # noqa: E402
+from map_util import build_choro_data, build_choro_dict, build_choropleth, load_features  # noqa: E402
+from query_util import available_backends, create_backend  # noqa: E402
+from table_util import search_rows, sort_rows, page_rows  # noqa: E402
+
+
+def measure(fn, repeat: int) -> dict:
+    """
+    Runs a benchmark several times and once more with tracemalloc for the peak memory.
+    Returns:
+        dict: Median, minimum and maximum time in seconds, and the peak memory in bytes.
+    """
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"median_s": statistics.median(times), "min_s": min(times), "max_s": max(times), "peak_bytes": peak}
+
+
+#----------------------------------------------------------------
+# Synthetic datasets: the OECD csv repeated with renamed countries, so that the number of rows grows
+# while the columns (and with it the projection and parsing work) stay realistic.
+#----------------------------------------------------------------
+
+def synthetic_csv(scale: int, directory: Path) -> Path:
+    """
+    Creates (or reuses) a csv with scale times the rows of OCED_simplified.csv.
+    Returns:
+        Path: Path of the csv.
+    """
+    path = directory / f"OCED_simplified_x{scale}.csv"
+    if path.exists():
+        return path
+    directory.mkdir(parents=True, exist_ok=True)
+    if scale == 1:
+        shutil.copy(DataModel.file_path, path)
+        return path
+    source = pd.read_csv(DataModel.file_path)
+    with open(path, "w", newline="") as f:
+        for i in range(scale):
+            copy = source.copy()
+            if i > 0:
+                copy["country"] = copy["country"] + f" {i}"
+            copy.to_csv(f, index=False, header=(i == 0))
+    return path
+
+
+#----------------------------------------------------------------
+# Benchmarks. Every function returns a dict of name -> callable.
+#----------------------------------------------------------------
+
+def data_benchmarks(file_path: Path, label: str) -> dict:
+    # The csv has to be in a directory owned by the benchmarks, as the cold start removes its binary cache.
+    cache_dir = file_path.parent / ".cache" / file_path.stem
+
+    def cold_start():
+        # Without a binary cache: the csv is parsed and the cache is written.
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        DataModel(file_path)
+
+    dm = DataModel(file_path)
+
+    def filter_lists():
+        dm.get_data()
+        dm.get_years()
+        dm.get_countries()
+        dm.get_cancer_types()
+        dm.get_screenings()
+
+    countries = dm.get_countries()
+    years = dm.get_years()
+    columns = list(dm.get_data().columns[2:])
+    year_ranges = list(itertools.combinations_with_replacement(years, 2))
+
+    def table_sweep():
+        # Same work as the table: selection, search, sort and the first page.
+        selections = [((years[0], years[-1]), [country], columns) for country in countries]
+        selections += [(years_range, countries, columns[-7:-5]) for years_range in year_ranges]
+        selections += [((years[0], years[-1]), countries, [column]) for column in columns]
+        for year_range, selected, cols in selections:
+            df = dm.select(year_range, selected, cols)
+            df = sort_rows(search_rows(df, ""), cols[0], descending=True)
+            page_rows(df, 1, 25)
+
+    derived = [column for column in dm.get_columns() if column not in columns]
+
+    def derived_select():
+        # All derived metrics of all countries and years, added to the selection from the cube.
+        dm.select((years[0], years[-1]), countries, derived)
+
+    def table_search():
+        df = dm.select((years[0], years[-1]), countries, columns)
+        search_rows(df, "an")
+
+    def backend_sweep(backend):
+        # The selections of the table sweep through one query backend, without searching, sorting and paging.
+        def run():
+            for country in countries:
+                backend.select((years[0], years[-1]), [country], columns)
+            for years_range in year_ranges:
+                backend.select(years_range, countries, columns[-7:-5])
+        return run
+
+    backends = {f"{label}/select_{name}": backend_sweep(create_backend(name, dm.get_data(), file_path)) for name in available_backends()}
+
+    measures = [dm.get_measure(cancer_type, unit) for cancer_type in dm.get_cancer_types() for unit in dm.get_units(cancer_type)]
+    _, names = load_features()
+
+    def choro_vectors():
+        for year in years:
+            for measure in measures:
+                dm.get_vector(measure, year, names)
+
+    return {
+        f"{label}/data_model_cold": cold_start,
+        f"{label}/data_model_warm": lambda: DataModel(file_path),
+        f"{label}/filter_lists": filter_lists,
+        f"{label}/table_sweep": table_sweep,
+        f"{label}/table_search": table_search,
+        f"{label}/derived_select": derived_select,
+        f"{label}/choro_vectors": choro_vectors,
+        **backends,
+    }
+
+
+def map_benchmarks() -> dict:
+    dm = get_data_model()
+    combinations = [(year, dm.get_measure(cancer_type, unit))
+                    for year in dm.get_years()[:-1] for cancer_type in dm.get_cancer_types() for unit in dm.get_units(cancer_type)]
+
+    def choro_dicts():
+        # Every (year, cancer type, unit) the map can show, without the result cache.
+        for year, measure in combinations:
+            build_choro_dict(year, measure)
+
+    def choropleths():
+        # Preparing and styling the layer for every cancer type and unit of one year, at the initial level of detail.
+        for cancer_type in dm.get_cancer_types():
+            for unit in dm.get_units(cancer_type):
+                build_choropleth(4, dm.get_years()[0], cancer_type, unit)
+
+    cm = CountryModel()
+    countries = dm.get_countries()
+    positions = [cm.get_centroid(country) for country in countries]
+
+    def centroids():
+        for country in countries:
+            cm.get_centroid(country)
+
+    def clicks():
+        # Resolving clicks at the centroid of every country of the dataset through the spatial index.
+        for lat, lon in positions:
+            cm.locate(lat, lon)
+
+    return {
+        "map/choro_join": build_choro_data.__wrapped__,
+        "map/choro_dicts": choro_dicts,
+        "map/choropleths": choropleths,
+        "map/centroid_lookups": centroids,
+        "map/click_lookups": clicks,
+        "map/country_index": CountryModel,
+    }
+
+
+#----------------------------------------------------------------
+# Baseline comparison.
+#----------------------------------------------------------------
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Lists the benchmarks that are slower (or use more memory) than the baseline by more than the tolerance.
+    Returns:
+        list[str]: Descriptions of the regressions.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for key in ("median_s", "peak_bytes"):
+            before, after = baseline[name][key], result[key]
+            if before > 0 and after > before * (1 + tolerance):
+                regressions.append(f"{name}: {key} {before:.6g} -> {after:.6g} (+{(after / before - 1) * 100:.0f}%)")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmarks for the OECD cancer dashboard.")
+    parser.add_argument("--scales", type=int, nargs="*", default=[10], help="Synthetic dataset sizes, as multiples of the csv (e.g. 10 100 1000).")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per benchmark.")
+    parser.add_argument("--filter", default="", help="Only run benchmarks whose name contains this text.")
+    parser.add_argument("--baseline", type=Path, default=BENCH_DIR / "baseline.json", help="Baseline file to compare with.")
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as the new baseline.")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown before a result counts as regression.")
+    parser.add_argument("--output", type=Path, help="Also write the results as JSON to this file.")
+    args = parser.parse_args()
+
+    benchmarks = {}
+    benchmarks.update(map_benchmarks())
+    for scale in [1, *args.scales]:
+        benchmarks.update(data_benchmarks(synthetic_csv(scale, BENCH_DIR / ".data"), f"x{scale}"))
+
+    results = {}
+    print(f"{'benchmark':<32} {'median':>12} {'min':>12} {'peak memory':>14}")
+    for name, fn in benchmarks.items():
+        if args.filter not in name:
+            continue
+        results[name] = measure(fn, args.repeat)
+        print(f"{name:<32} {results[name]['median_s'] * 1000:>10.2f}ms {results[name]['min_s'] * 1000:>10.2f}ms {results[name]['peak_bytes'] / 2**20:>11.2f}MiB")
+
+    report = {"python": platform.python_version(), "pandas": pd.__version__, "machine": platform.machine(), "results": results}
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2))
+
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(report, indent=2))
+        print(f"Baseline written to {args.baseline}.")
+        return 0
+
+    if not args.baseline.exists():
+        print("No baseline to compare with, run with --save-baseline first.")
+        return 0
+
+    regressions = compare(results, json.loads(args.baseline.read_text())["results"], args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    print(f"{len(regressions)} regression(s) compared to {args.baseline}.")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
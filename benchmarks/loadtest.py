@@ -0,0 +1,406 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+from pathlib import Path
+
+import numpy as np
+import websockets
+
+#----------------------------------------------------------------
+# Load test for the dashboard: starts the app locally, opens many simulated Shiny sessions over the websocket
+# and replays interaction scripts (switching tabs, changing the map filters, the table countries, columns and years).
+# Reports throughput, latency percentiles and payload sizes per output, and the memory (RSS) of the workers.
+# Usage (from the repository root):
+#   python benchmarks/loadtest.py                                 10 sessions for 30 seconds
+#   python benchmarks/loadtest.py --sessions 1 10 25 50           one run per number of concurrent sessions
+#   python benchmarks/loadtest.py --workers 4 --env DASHBOARD_RENDER_EXECUTOR=thread
+#   python benchmarks/loadtest.py --url http://127.0.0.1:8000 --pid 1234   against a running app
+# Latencies are measured from sending an input to receiving the output, including the debounce of the filters
+# (DASHBOARD_FILTER_DEBOUNCE_SECONDS).
+#----------------------------------------------------------------
+
+APP_DIR = Path(__file__).resolve().parent.parent / "app"
+sys.path.insert(0, str(APP_DIR))
+
+from data_util import get_data_model  # noqa: E402
+
+# Outputs of every tab, which are rendered when the tab is shown for the first time.
+TAB_OUTPUTS = {"map": ("map", "map_header"), "data_table": ("total_df", "table_header")}
+OUTPUT_IDS = {"map": "map-map", "map_header": "map-map_header", "total_df": "data_table-total_df", "table_header": "data_table-table_header"}
+
+# Seconds to wait for the outputs of an action before counting them as timed out.
+OUTPUT_TIMEOUT = 30
+
+
+class Recorder():
+    """
+    The Recorder class collects latencies, payload sizes and counts of all sessions of one run.
+    """
+
+    def __init__(self) -> None:
+        self.latencies = {}
+        self.payloads = {}
+        self.actions = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    def latency(self, output: str, seconds: float) -> None:
+        self.latencies.setdefault(output, []).append(seconds)
+
+    def payload(self, output: str, size: int) -> None:
+        self.payloads.setdefault(output, []).append(size)
+
+
+def outputs_of(message: dict, size: int) -> list[tuple[str, int]]:
+    """
+    Finds the outputs rendered by a message from the server, with their payload sizes.
+    Returns:
+        list[tuple[str, int]]: Output names and sizes in bytes.
+    """
+    outputs = []
+    names = {output_id: name for name, output_id in OUTPUT_IDS.items()}
+    for output_id, value in (message.get("values") or {}).items():
+        if output_id in names:
+            outputs.append((names[output_id], len(json.dumps(value))))
+    custom = message.get("custom") or {}
+    if "shinywidgets_comm_open" in custom:
+        # A new widget (map, layers, controls) sends its whole state when it is opened, e.g. the geometry of the layer.
+        # These messages come before the output value of the map and are added to its payload.
+        outputs.append(("map_open", size))
+    comm = custom.get("shinywidgets_comm_msg")
+    if comm is not None:
+        # The map widget is updated through comm messages, the one carrying the styled layer data counts as the render.
+        data = json.loads(comm).get("content", {}).get("data", {})
+        if data.get("method") == "update" and "data" in data.get("state", {}):
+            outputs.append(("map", size))
+    return outputs
+
+
+class Session():
+    """
+    The Session class simulates one user of the dashboard: it waits for the outputs of every action before
+    thinking for a while and taking the next one, like a user reading the page.
+    """
+
+    def __init__(self, url: str, recorder: Recorder, rng: random.Random, think: float) -> None:
+        self.url = url
+        self.recorder = recorder
+        self.rng = rng
+        self.think = think
+        self.pending = {}
+        self.done = asyncio.Event()
+        self.started = set()
+        self.opened = 0
+
+        dm = get_data_model()
+        self.choices = {
+            "map-year_map": [str(year) for year in dm.get_years()[:-1]],
+            "map-cancer_type_map": sorted(dm.get_cancer_types()),
+        }
+        self.units = {cancer_type: dm.get_units(cancer_type) for cancer_type in self.choices["map-cancer_type_map"]}
+        self.years = dm.get_years()
+        self.countries = dm.get_countries()
+        self.columns = dm.get_columns()
+        self.inputs = {
+            "tab": "map",
+            "map-year_map": self.choices["map-year_map"][0],
+            "map-cancer_type_map": self.choices["map-cancer_type_map"][0],
+            "map-units_map": self.units[self.choices["map-cancer_type_map"][0]][0],
+            "data_table-year_table": [self.years[0], self.years[-1]],
+            "data_table-columns_table": list(dm.get_data().columns[-7:-5]),
+            "data_table-countries_table": self.countries[:3],
+            "data_table-search_table": "",
+            "data_table-sort_table": "year",
+            "data_table-order_table": "asc",
+            "data_table-page_size_table": "25",
+            "data_table-page_table": 1,
+            "data_table-export_format_table": "csv",
+        }
+
+    def visibility(self, tab: str) -> dict:
+        # The browser reports the outputs of hidden tabs as hidden, Shiny does not render them.
+        return {f".clientdata_output_{output_id}_hidden": name not in TAB_OUTPUTS[tab]
+                for name, output_id in OUTPUT_IDS.items()}
+
+    async def run(self, stop_at: float) -> None:
+        async with websockets.connect(self.url, max_size=None) as ws:
+            receiver = asyncio.create_task(self.receive(ws))
+            try:
+                self.expect(TAB_OUTPUTS["map"])
+                self.started.add("map")
+                await ws.send(json.dumps({"method": "init", "data": {**self.inputs, **self.visibility("map")}}))
+                await self.wait()
+                while time.monotonic() < stop_at:
+                    await asyncio.sleep(self.rng.expovariate(1 / self.think) if self.think > 0 else 0)
+                    update, outputs = self.next_action()
+                    self.recorder.actions += 1
+                    self.expect(outputs)
+                    await ws.send(json.dumps({"method": "update", "data": update}))
+                    await self.wait()
+            finally:
+                receiver.cancel()
+
+    def expect(self, outputs) -> None:
+        now = time.perf_counter()
+        self.pending = {output: now for output in outputs}
+        self.done.clear()
+        if not self.pending:
+            self.done.set()
+
+    async def wait(self) -> None:
+        try:
+            await asyncio.wait_for(self.done.wait(), OUTPUT_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.recorder.timeouts += len(self.pending)
+            self.pending = {}
+
+    async def receive(self, ws) -> None:
+        async for raw in ws:
+            message = json.loads(raw)
+            if message.get("errors"):
+                self.recorder.errors += 1
+            for output, size in outputs_of(message, len(raw)):
+                if output == "map_open":
+                    self.opened += size
+                    continue
+                if output == "map":
+                    size, self.opened = size + self.opened, 0
+                self.recorder.payload(output, size)
+                if output in self.pending:
+                    self.recorder.latency(output, time.perf_counter() - self.pending.pop(output))
+            if not self.pending:
+                self.done.set()
+
+    def next_action(self) -> tuple[dict, tuple]:
+        """
+        Picks the next interaction of the user on the current tab, now and then switching tabs.
+        Returns:
+            tuple[dict, tuple]: Changed inputs and the outputs expected to render.
+        """
+        tab = self.inputs["tab"]
+        if self.rng.random() < 0.1:
+            tab = "data_table" if tab == "map" else "map"
+            self.inputs["tab"] = tab
+            outputs = () if tab in self.started else TAB_OUTPUTS[tab]
+            self.started.add(tab)
+            return {"tab": tab, **self.visibility(tab)}, outputs
+
+        if tab == "map":
+            input_id = self.rng.choice(["map-year_map", "map-cancer_type_map", "map-units_map"])
+            choices = self.units[self.inputs["map-cancer_type_map"]] if input_id == "map-units_map" else self.choices[input_id]
+            value = self.rng.choice([choice for choice in choices if choice != self.inputs[input_id]])
+            before = self.map_values()
+            self.inputs[input_id] = value
+            update = {input_id: value}
+            # Like the browser, which gets the units of a new cancer type and falls back to the first one.
+            units = self.units[self.inputs["map-cancer_type_map"]]
+            if self.inputs["map-units_map"] not in units:
+                self.inputs["map-units_map"] = update["map-units_map"] = units[0]
+            # The map only changes if its values do, e.g. not between two metrics without any data in that year.
+            if np.array_equal(before, self.map_values(), equal_nan=True):
+                return update, ("map_header",)
+            return update, TAB_OUTPUTS[tab]
+        else:
+            input_id = self.rng.choice(["data_table-countries_table", "data_table-columns_table", "data_table-year_table"])
+            if input_id == "data_table-year_table":
+                value = sorted(self.rng.sample(self.years, 2))
+            else:
+                options = self.countries if input_id == "data_table-countries_table" else self.columns
+                value = self.toggle(self.inputs[input_id], options)
+        self.inputs[input_id] = value
+        return {input_id: value}, TAB_OUTPUTS[tab]
+
+    def map_values(self):
+        # Values of the countries on the map for the selected filters.
+        dm = get_data_model()
+        measure = dm.get_measure(self.inputs["map-cancer_type_map"], self.inputs["map-units_map"])
+        return dm.get_vector(measure, int(self.inputs["map-year_map"]), self.countries)
+
+    def toggle(self, selected: list, options: list) -> list:
+        # Adds an option to a selectize input or removes one, keeping at least one selected.
+        if len(selected) > 1 and self.rng.random() < 0.5:
+            drop = self.rng.choice(selected)
+            return [value for value in selected if value != drop]
+        return selected + [self.rng.choice([option for option in options if option not in selected])]
+
+
+#----------------------------------------------------------------
+# Memory of the app: RSS of the server process and its worker processes, read from /proc (Linux only).
+#----------------------------------------------------------------
+
+def process_tree(pid: int) -> list[int]:
+    pids = [pid]
+    for task in Path(f"/proc/{pid}/task").glob("*"):
+        try:
+            pids += [child for child_pid in (task / "children").read_text().split() for child in process_tree(int(child_pid))]
+        except OSError:
+            continue
+    return pids
+
+
+def rss_bytes(pid: int) -> int:
+    try:
+        for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+async def sample_rss(pid: int, samples: dict, interval: float = 0.5) -> None:
+    while True:
+        for process in process_tree(pid):
+            samples.setdefault(process, []).append(rss_bytes(process))
+        await asyncio.sleep(interval)
+
+
+#----------------------------------------------------------------
+# Running the sessions and reporting.
+#----------------------------------------------------------------
+
+async def run_level(url: str, sessions: int, duration: float, think: float, ramp_up: float, pid, seed: int) -> dict:
+    recorder = Recorder()
+    rss = {}
+    sampler = asyncio.create_task(sample_rss(pid, rss)) if pid else None
+    start = time.monotonic()
+    stop_at = start + duration
+
+    async def user(i: int) -> None:
+        # Sessions are started evenly over the ramp up, so they do not all connect in the same instant.
+        await asyncio.sleep(ramp_up * i / sessions)
+        try:
+            await Session(url, recorder, random.Random(seed + i), think).run(stop_at)
+        except (OSError, websockets.WebSocketException):
+            recorder.errors += 1
+
+    await asyncio.gather(*(user(i) for i in range(sessions)))
+    elapsed = time.monotonic() - start
+    if sampler is not None:
+        sampler.cancel()
+    return summarize(recorder, sessions, elapsed, rss)
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(q / 100 * len(values)) - 1))]
+
+
+def summarize(recorder: Recorder, sessions: int, elapsed: float, rss: dict) -> dict:
+    outputs = {}
+    for output in OUTPUT_IDS:
+        latencies = recorder.latencies.get(output, [])
+        payloads = recorder.payloads.get(output, [])
+        outputs[output] = {
+            "renders": len(latencies),
+            "p50_s": percentile(latencies, 50) if latencies else None,
+            "p95_s": percentile(latencies, 95) if latencies else None,
+            "p99_s": percentile(latencies, 99) if latencies else None,
+            "max_s": max(latencies) if latencies else None,
+            "payload_mean_bytes": statistics.mean(payloads) if payloads else None,
+            "payload_max_bytes": max(payloads) if payloads else None,
+        }
+    renders = sum(output["renders"] for output in outputs.values())
+    return {
+        "sessions": sessions,
+        "seconds": elapsed,
+        "actions_per_s": recorder.actions / elapsed,
+        "renders_per_s": renders / elapsed,
+        "timeouts": recorder.timeouts,
+        "errors": recorder.errors,
+        "outputs": outputs,
+        "rss": {str(pid): {"start_bytes": values[0], "peak_bytes": max(values), "end_bytes": values[-1]} for pid, values in rss.items()},
+    }
+
+
+def print_level(result: dict) -> None:
+    ms = lambda value: f"{value * 1000:>9.1f}" if value is not None else f"{'-':>9}"
+    size = lambda value: f"{value / 1024:>10.1f}" if value is not None else f"{'-':>10}"
+    print(f"\n{result['sessions']} session(s): {result['actions_per_s']:.1f} actions/s, {result['renders_per_s']:.1f} renders/s, "
+          f"{result['timeouts']} timeout(s), {result['errors']} error(s)")
+    print(f"{'output':<14} {'renders':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9} {'mean KiB':>10} {'max KiB':>10}")
+    for output, stats in result["outputs"].items():
+        print(f"{output:<14} {stats['renders']:>8} {ms(stats['p50_s'])} {ms(stats['p95_s'])} {ms(stats['p99_s'])} {ms(stats['max_s'])} "
+              f"{size(stats['payload_mean_bytes'])} {size(stats['payload_max_bytes'])}")
+    for pid, stats in result["rss"].items():
+        print(f"process {pid}: RSS {stats['start_bytes'] / 2**20:.1f} MiB at start, {stats['peak_bytes'] / 2**20:.1f} MiB peak, "
+              f"{stats['end_bytes'] / 2**20:.1f} MiB at end")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_app(port: int, workers: int, env: list[str]) -> subprocess.Popen:
+    """
+    Starts the app with uvicorn and waits until it answers.
+    Returns:
+        subprocess.Popen: The server process.
+    """
+    environment = dict(os.environ, **dict(item.split("=", 1) for item in env))
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "app:app", "--port", str(port), "--workers", str(workers), "--log-level", "warning"],
+                              cwd=APP_DIR, env=environment)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=1).read()
+            return server
+        except OSError:
+            if server.poll() is not None:
+                raise RuntimeError("The app did not start.")
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("The app did not answer within 60 seconds.")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Load test for the OECD cancer dashboard.")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[10], help="Concurrent sessions, one run per number.")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds per run.")
+    parser.add_argument("--think", type=float, default=1.0, help="Mean think time between the actions of a user, in seconds.")
+    parser.add_argument("--ramp-up", type=float, default=5, help="Seconds over which the sessions of a run are started.")
+    parser.add_argument("--workers", type=int, default=1, help="Uvicorn workers of the started app.")
+    parser.add_argument("--env", action="append", default=[], help="Setting for the started app, e.g. DASHBOARD_RENDER_EXECUTOR=thread.")
+    parser.add_argument("--url", help="Test a running app at this address instead of starting one.")
+    parser.add_argument("--pid", type=int, help="Process id of the running app, for its memory.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the interaction scripts.")
+    parser.add_argument("--output", type=Path, help="Also write the results as JSON to this file.")
+    args = parser.parse_args()
+
+    server = None
+    if args.url:
+        base, pid = args.url.rstrip("/"), args.pid
+    else:
+        port = free_port()
+        server = start_app(port, args.workers, args.env)
+        base, pid = f"http://127.0.0.1:{port}", server.pid
+    url = base.replace("http", "ws", 1) + "/websocket/"
+
+    results = []
+    try:
+        for sessions in args.sessions:
+            result = asyncio.run(run_level(url, sessions, args.duration, args.think, args.ramp_up, pid, args.seed))
+            print_level(result)
+            results.append(result)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    if args.output:
+        args.output.write_text(json.dumps({"settings": vars(args) | {"output": str(args.output)}, "results": results}, indent=2))
+    return 1 if any(result["errors"] or result["timeouts"] for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())